@@ -1,9 +1,24 @@
 from dataclasses import dataclass
+import sys
+import weakref
+
+
+def intern_id(identifier: str|None) -> str|None:
+    """Returns the interned copy of an identifier repeated on many objects (relation type, model name)"""
+    return sys.intern(identifier) if isinstance(identifier, str) else identifier
+
+
+def set_dict_state(obj, state: dict):
+    """Restores the attributes of a slotted object from the __dict__ state of the pickles saved before __slots__"""
+    for name, value in state.items():
+        setattr(obj, name, value)
 
 
 class UsemBase:
     """Represents the minimum data for a usem"""
 
+    __slots__ = ("usem", "definition")
+
     def __init__(self, usem, definition):
         """Usem minimum data
 
@@ -24,9 +39,50 @@ class UsemBase:
         return {'usem': self.usem, 'definition': self.definition}
 
 
-class Relation(UsemBase):
+class RelationTarget(UsemBase):
+    """Represents a usem target of relations, shared by all the relations pointing to it"""
+
+    __slots__ = ("lemma", "__weakref__")
+
+    def __init__(self, usem, lemma, definition):
+        """Initialize a relation target
+
+        Parameters:
+            usem (str): identifier of the related usem
+            lemma (str): lemma to which the related usem belongs
+            definition (str): definition of the related usem
+        """
+        super().__init__(usem, definition)
+        self.lemma = lemma
+
+
+    def __getstate__(self) -> tuple:
+        return (self.usem, self.lemma, self.definition)
+
+
+    def __setstate__(self, state: tuple):
+        self.usem, self.lemma, self.definition = state
+
+
+relation_targets: weakref.WeakValueDictionary[tuple, RelationTarget] = weakref.WeakValueDictionary()
+"""Shared target-sense table: relations pointing to the same usem reference the same RelationTarget.
+A target is dropped from the table when no relation references it anymore"""
+
+
+def relation_target(usem, lemma, definition) -> RelationTarget:
+    """Returns the shared RelationTarget of a usem, creating it if missing"""
+    key = (usem, lemma, definition)
+    target = relation_targets.get(key)
+    if target is None:
+        target = relation_targets[key] = RelationTarget(usem, lemma, definition)
+    return target
+
+
+class Relation:
     """Represents a relation with another usem"""
 
+    __slots__ = ("target", "type", "example")
+
     def __init__(self, usem, lemma, definition, type, example):
         """Initialize a relation with another usem
 
@@ -36,11 +92,36 @@ class Relation(UsemBase):
             definition (str): definition of the related usem
             type (str): relation type (es. hyponym)
         """
-        super().__init__(usem, definition)
-        self.lemma = lemma
-        self.type = type
+        self.target = relation_target(usem, lemma, definition)
+        self.type = intern_id(type)
         self.example = example
 
+
+    @property
+    def usem(self) -> str:
+        return self.target.usem
+
+
+    @property
+    def lemma(self) -> str:
+        return self.target.lemma
+
+
+    @property
+    def definition(self) -> str|None:
+        return self.target.definition
+
+
+    def __getstate__(self) -> tuple:
+        return (self.target, self.type, self.example)
+
+
+    def __setstate__(self, state: tuple|dict):
+        if isinstance(state, dict): #pickle saved before the shared target table
+            self.__init__(state['usem'], state['lemma'], state['definition'], state['type'], state['example'])
+        else:
+            self.target, self.type, self.example = state
+
     
     def to_dict(self) -> dict[str, any]:
         """Returns a dictionary version of the object
@@ -54,6 +135,7 @@ class Relation(UsemBase):
 @dataclass
 class Score:
     """Represents the score given by a LLM as a judge"""
+    __slots__ = ("model", "score")
     model: str
     """judge model name"""
     score: int
@@ -69,9 +151,26 @@ class Score:
         return {'model': self.model, 'score': self.score}
 
 
+    def __post_init__(self):
+        self.model = intern_id(self.model)
+
+
+    def __getstate__(self) -> tuple:
+        return (self.model, self.score)
+
+
+    def __setstate__(self, state: tuple|dict):
+        if isinstance(state, dict): #pickle saved before __slots__
+            set_dict_state(self, state)
+            self.model = intern_id(self.model)
+        else:
+            self.model, self.score = state
+
+
 @dataclass
 class AIDefinition:
     """Represents the definition generated by an LLM"""
+    __slots__ = ("model", "definition", "scores", "mean_score")
     model: str
     """model name of the LLM used for generation"""
     definition: str
@@ -88,14 +187,28 @@ class AIDefinition:
         """
         return {'model': self.model, 'definition': self.definition, 'scores': [score.to_dict() for score in self.scores]}
 
+
+    def __post_init__(self):
+        self.model = intern_id(self.model)
+
+
+    def __getstate__(self) -> tuple:
+        return (self.model, self.definition, self.scores, self.mean_score)
+
+
+    def __setstate__(self, state: tuple|dict):
+        if isinstance(state, dict): #pickle saved before __slots__
+            set_dict_state(self, state)
+            self.model = intern_id(self.model)
+        else:
+            self.model, self.definition, self.scores, self.mean_score = state
+
 @dataclass
 class UsemEntry(UsemBase):
     """Represents a usem for the elaboration"""
 
-    chosenAiDef = "" 
-    chosenAiDefScore = 0.0
-    chosenAiDefModelGenerator = ""
-    
+    __slots__ = ("template", "example", "relations", "ai_definitions", "chosenAiDef", "chosenAiDefScore", "chosenAiDefModelGenerator")
+
     def __init__(self, usem, definition, template, example, relations,  ai_definitions, chosen_definition=None, chosen_score=None, chosen_model=None):
         """Initialize a UsemEntry
 
@@ -127,8 +240,24 @@ class UsemEntry(UsemBase):
                 'chosen_ai_definition':self.chosenAiDef, 'chosen_mean_ai_score':self.chosenAiDefScore, 'chosen_ai_model':self.chosenAiDefModelGenerator}
 
 
+    def __getstate__(self) -> tuple:
+        return (self.usem, self.definition, self.template, self.example, self.relations, self.ai_definitions,
+                self.chosenAiDef, self.chosenAiDefScore, self.chosenAiDefModelGenerator)
+
+
+    def __setstate__(self, state: tuple|dict):
+        if isinstance(state, dict): #pickle saved before __slots__
+            self.chosenAiDef, self.chosenAiDefScore, self.chosenAiDefModelGenerator = "", 0.0, "" #former class defaults
+            set_dict_state(self, state)
+        else:
+            (self.usem, self.definition, self.template, self.example, self.relations, self.ai_definitions,
+             self.chosenAiDef, self.chosenAiDefScore, self.chosenAiDefModelGenerator) = state
+
+
 class LexicalEntry:
 
+    __slots__ = ("lemma", "lemma_id", "senses")
+
     def __init__(self, lemma, lemma_id, senses):
         self.lemma:str = lemma
         self.lemma_id:str = lemma_id
@@ -141,4 +270,15 @@ class LexicalEntry:
         Returns:
             dictionary (dict[str, any]): dictionary version of the object
         """
-        return {'lemma': self.lemma, 'lemma_id': self.lemma_id, 'senses': [sense.to_dict() for sense in self.senses]}
\ No newline at end of file
+        return {'lemma': self.lemma, 'lemma_id': self.lemma_id, 'senses': [sense.to_dict() for sense in self.senses]}
+
+
+    def __getstate__(self) -> tuple:
+        return (self.lemma, self.lemma_id, self.senses)
+
+
+    def __setstate__(self, state: tuple|dict):
+        if isinstance(state, dict): #pickle saved before __slots__
+            set_dict_state(self, state)
+        else:
+            self.lemma, self.lemma_id, self.senses = state
\ No newline at end of file
@@ -0,0 +1,115 @@
+from functools import lru_cache
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+
+class JsonObjectScanner:
+    """Finds the end of the first JSON object of a streamed reply, fed one chunk at a time
+
+    Text before the object (a preamble, the ```json fence) is skipped, braces inside strings are ignored.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+
+
+    def feed(self, text: str) -> bool:
+        """Scans a chunk of the reply
+
+        Returns:
+            complete (bool): True once the first JSON object is closed
+        """
+        for char in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == "{":
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+
+def early_stop_chunk(chunks: int) -> ChatGenerationChunk:
+    """Returns the last chunk of a stream stopped at the end of the JSON object
+
+    The server reports the usage only at the end of the stream, so the reply has no usage metadata: the prompt
+    tokens are unknown, the output tokens are estimated in output_tokens_estimate with the chunks received
+    (one token each for Ollama and the OpenAI compatible APIs).
+    """
+    return ChatGenerationChunk(message=AIMessageChunk(content="", response_metadata={"done_reason": "early_stop",
+                                                                                     "output_tokens_estimate": chunks}))
+
+
+class EarlyStopMixin:
+    """Streams every request of a chat model and closes the stream as soon as the JSON object of the reply is complete
+
+    The model stops generating when the connection is closed, so the tokens a verbose model would add after
+    the object are neither generated nor paid. The requests still go through the LLM cache, the rate limiter
+    and the callbacks of the model, which get the message aggregated from the chunks.
+    """
+
+    def _should_stream(self, *, async_api: bool, run_manager=None, **kwargs) -> bool:
+        return True
+
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        scanner = JsonObjectScanner()
+        chunks = 0
+        stream = super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            for chunk in stream:
+                yield chunk
+                chunks += 1
+                if scanner.feed(chunk.text):
+                    yield early_stop_chunk(chunks)
+                    return
+        finally:
+            stream.close()
+
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        scanner = JsonObjectScanner()
+        chunks = 0
+        stream = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        try:
+            async for chunk in stream:
+                yield chunk
+                chunks += 1
+                if scanner.feed(chunk.text):
+                    yield early_stop_chunk(chunks)
+                    return
+        finally:
+            await stream.aclose()
+
+
+@lru_cache(maxsize=None)
+def early_stop_class(chat_class: type[BaseChatModel]) -> type[BaseChatModel]:
+    """Returns the subclass of a chat model class stopping the replies at the end of the JSON object, created once"""
+    return type(chat_class.__name__, (EarlyStopMixin, chat_class), {"__module__": chat_class.__module__})
+
+
+def early_stop_model(llm: BaseChatModel) -> BaseChatModel:
+    """Makes a chat model stop each reply at the end of its JSON object (see EarlyStopMixin)
+
+    Parameters:
+        llm (BaseChatModel): chat model implementing the streaming
+
+    Returns:
+        llm (BaseChatModel): the same model, with the early stop
+    """
+    llm.__class__ = early_stop_class(type(llm))
+    return llm
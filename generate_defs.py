@@ -3,17 +3,33 @@ import json
 from collections import OrderedDict
 from complit_generation import *
 from sparql import *
-from utility import format_relation, config_model
+from sparql_cache import CACHE_MODES, SparqlCache
+from utility import config_model, EXCLUDE_MODES, load_relation_types, mode_exclude, mode_path, RELATION_TYPES_PATH
+from llm_cache import LLMCache
+from journal import Journal, journal_path
+from json_export import export_format, open_compressed, write_lexicon
+from lexicon_store import LexiconStore, is_lexicon_store, load_lexicon, save_lexicon
+from prompt_rendering import (PROMPT_LAYOUTS, build_generation_prompt, build_lemma_prompt, context_key, definition_token_budget, output_parser,
+                              scale_output_limit, structured_chain, system_prompt)
+from ollama_backend import POOL_STRATEGIES, OllamaPool, parse_keep_alive, unload_model, warm_up_model
+from run_stats import ModelStats
+from rate_limit import PROVIDER_LIMITS_PATH, ainvoke_with_backoff, configure_rate_limits, invoke_with_backoff, rate_limiters
 import gc
+import copy
+import os
 import pickle
 from langchain_core.output_parsers.pydantic import PydanticOutputParser
 import pydantic_models
-from langchain_core.prompts import PromptTemplate
 from langchain_core.exceptions import OutputParserException
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.runnables import Runnable
 from tqdm import tqdm
 import time
 import sys
+import queue
+import asyncio
+import threading
+from typing import Callable, Iterable, Iterator, Sized
 
 
 def parse_relations(relations_json) -> list[Relation]:
@@ -65,7 +81,7 @@ def parse_ai_definitions(json_ai_definitions) -> list[AIDefinition]:
     if json_ai_definitions == None:
         return results
     for definition in json_ai_definitions:
-        ai_def = AIDefinition(definition['model'], definition['definition'], parse_scores(definition['scores']))
+        ai_def = AIDefinition(definition['model'], definition['definition'], parse_scores(definition['scores']), 0.0)
         results.append(ai_def)
     return results
 
@@ -124,133 +140,652 @@ def reading_json_complit(input_path: str) -> list[LexicalEntry]:
         results.append(lexical_extry)
     return results
 
-def generate_definitions(lexical_entries: list[LexicalEntry], isAllSenses: bool, modelname: str, 
+
+def iter_json_rows(input_path: str) -> Iterator[dict]:
+    """Yields the items of a json array one at a time, or the lines of a JSONL file
+
+    The json array is parsed incrementally with ijson, so the memory does not grow with the export.
+    Files compressed with gzip or zstd are read according to their extension (e.g. .jsonl.gz).
+    """
+    format, compression = export_format(input_path)
+    if format == "jsonl":
+        with open_compressed(input_path, compression, "rt") as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    try:
+        import ijson
+    except ImportError:
+        raise ImportError("reading the json array {} requires the ijson package: pip install ijson".format(input_path))
+    with open_compressed(input_path, compression, "rb") as file:
+        yield from ijson.items(file, "item", use_float=True)
+
+
+def iter_json_complit(input_path: str) -> Iterator[LexicalEntry]:
+    """Lazily reads a json/JSONL file representing CompL-it objects, yielding a LexicalEntry at a time
+
+    Rows are senses with their lemma_id, as read by reading_json_complit: the consecutive rows with the same
+    lemma_id form a lexical entry. Rows with senses (e.g. the output of generate_defs.py) are lexical entries.
+
+    Parameters:
+        input_path (str): relative path to the json or JSONL file
+    
+    Returns:
+        entries (Iterator[LexicalEntry]): CompL-it lexical entries with their senses, in the file order
+    """
+    current: LexicalEntry|None = None
+    for item in iter_json_rows(input_path):
+        if 'senses' in item:
+            if current is not None:
+                yield current
+                current = None
+            yield LexicalEntry(item['lemma'], item['lemma_id'], parse_usems(item['senses']))
+            continue
+        if current is not None and current.lemma_id != item['lemma_id']:
+            yield current
+            current = None
+        if current is None:
+            current = LexicalEntry(item.get('lemma'), item['lemma_id'], [])
+        current.senses.extend(parse_usems([{
+            'usem': item.get('usem'),
+            'definition': item.get('definition'),
+            'relations': item.get('relations'),
+            'template': item.get('template'),
+            'example': item.get('example'),
+            'ai_definitions': item.get('ai_definitions')
+            }]))
+    if current is not None:
+        yield current
+
+def prune_lexical_entry(le: LexicalEntry) -> bool:
+    """Removes the excluded relations of each sense, then the senses left without relations, in a single pass
+
+    The relation filters are already applied by the queries with the #FILTERS# placeholder:
+    here they only prune the relations retrieved by queries without it (or cached before the change).
+
+    Parameters:
+        le (LexicalEntry): lexical entry whose senses have the relations already retrieved
+
+    Returns:
+        keep (bool): False if the lexical entry has no sense left
+    """
+    filters = get_relation_filters()
+    senses = []
+    for sense in le.senses:
+        sense.relations = [x for x in sense.relations if filters.keeps(x)]
+        if sense.relations:
+            senses.append(sense)
+        else:
+            print("Removing Sense {} because have not usefull relations".format(sense.usem))
+    le.senses = senses
+    if (len(le.senses) == 0):
+        print("Removing {} lexical entry".format(le.lemma))
+        return False
+    return True
+
+
+def stream_lexical_entries(lev1: str, lev2: str, page_size: int, batch_size: int) -> Iterator[LexicalEntry]:
+    """Retrieves the lexical entries page by page, yielding each one as soon as its relations are retrieved and pruned
+
+    Parameters:
+        lev1 (str): path to level 1 query, for senses retrieval
+        lev2 (str): path to level 2 query, for relations retrieval
+        page_size (int): number of rows of each level 1 page
+        batch_size (int): number of senses whose relations are retrieved with a single level 2 query
+
+    Returns:
+        lexical_entries (Iterator[LexicalEntry]): lexical entries with pruned relations
+    """
+    chunk: list[LexicalEntry] = []
+    chunk_senses = 0
+    entries = iter_first_level_query(lev1, page_size)
+    while True:
+        le = next(entries, None)
+        if le is not None:
+            chunk.append(le)
+            chunk_senses += len(le.senses)
+        if chunk and (le is None or chunk_senses >= batch_size):
+            relationsBySense = second_level_query_batch(input_path=lev2,
+                                                        sense_ids=[sense.usem for le in chunk for sense in le.senses],
+                                                        batch_size=batch_size)
+            for chunk_le in chunk:
+                for sense in chunk_le.senses:
+                    sense.relations = list(relationsBySense[sense.usem])
+                if prune_lexical_entry(chunk_le):
+                    yield chunk_le
+            chunk = []
+            chunk_senses = 0
+        if le is None:
+            break
+
+
+def sync_lexical_entries(stored: list[LexicalEntry], lev1: str, lev2: str, batch_size: int) -> list[LexicalEntry]:
+    """Refreshes a stored lexicon against the SPARQL endpoint, retrieving the relations only of the new or changed senses
+
+    The senses of the level 1 query are compared with the stored ones by sense_fingerprint of their example,
+    template and relation (type, target), retrieved with the light RELATION_TARGETS_QUERY. Unchanged senses
+    keep the stored object, with its relations and AI definitions; new or changed senses get their relations
+    from the level 2 query and no AI definition. Senses no longer returned by the endpoint are dropped.
+
+    Parameters:
+        stored (list[LexicalEntry]): lexical entries of the pickle or lexicon store
+        lev1 (str): path to level 1 query, for senses retrieval
+        lev2 (str): path to level 2 query, for relations retrieval
+        batch_size (int): number of senses whose relations are retrieved with a single query
+
+    Returns:
+        lexical_entries (list[LexicalEntry]): the refreshed lexical entries, in the order of the level 1 query
+    """
+    stored_senses: dict[str, UsemEntry] = {}
+    for le in stored:
+        for sense in le.senses:
+            stored_senses.setdefault(sense.usem, sense)
+    lexical_entries = first_level_query(lev1)
+    targets = relation_targets_batch([sense.usem for le in lexical_entries for sense in le.senses], batch_size)
+    changed: list[UsemEntry] = []
+    unchanged = 0
+    for le in lexical_entries:
+        for i, sense in enumerate(le.senses):
+            old = stored_senses.pop(sense.usem, None)
+            if old is not None and (sense_fingerprint(old.example, old.template, ((rel.type, rel.usem) for rel in old.relations))
+                                    == sense_fingerprint(sense.example, sense.template, targets[sense.usem])):
+                le.senses[i] = old
+                unchanged += 1
+            else:
+                changed.append(sense)
+    relationsBySense = second_level_query_batch(input_path=lev2, sense_ids=[sense.usem for sense in changed], batch_size=batch_size)
+    for sense in changed:
+        sense.relations = relationsBySense[sense.usem]
+    print("Sync: {} unchanged senses, {} new or changed, {} removed".format(unchanged, len(changed), len(stored_senses)))
+    return [le for le in lexical_entries if prune_lexical_entry(le)]
+
+
+def queue_lexical_entries(lexical_entries: Iterator[LexicalEntry], queue_size: int) -> Iterator[LexicalEntry]:
+    """Consumes lexical_entries in a producer thread, through a bounded queue
+
+    Parameters:
+        lexical_entries (Iterator[LexicalEntry]): lexical entries produced by the retrieval
+        queue_size (int): max number of lexical entries retrieved and not yet consumed
+
+    Returns:
+        lexical_entries (Iterator[LexicalEntry]): the same lexical entries, in the same order
+    """
+    entries_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    done = object()
+    errors: list[BaseException] = []
+
+    def producer():
+        try:
+            for le in lexical_entries:
+                entries_queue.put(le)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            entries_queue.put(done)
+
+    threading.Thread(target=producer, name="retrieval", daemon=True).start()
+    while (le := entries_queue.get()) is not done:
+        yield le
+    if errors:
+        raise errors[0]
+
+
+def needs_generation(sense: UsemEntry, modelname: str, overwriteGeneration: bool) -> bool:
+    """Checks if a definition must be generated for a sense by a model
+
+    Parameters:
+        sense (UsemEntry): sense to be defined
+        modelname (str): name of the model used for generation
+        overwriteGeneration (bool): overwrite the definition already generated by the model
+
+    Returns:
+        needed (bool): True if the sense has no definition by the model or it must be overwritten
+    """
+    indice = next((i for i, d in enumerate(sense.ai_definitions) if d.model == modelname), None)
+    #check if definition generated by "modelname" is already present. If yes it will be overwritten
+    return indice is None or overwriteGeneration
+
+
+def sense_log_header(sense: UsemEntry, exclude: str) -> str:
+    """Returns the line describing a sense in the llm_defs log file"""
+    inputForPrompt = "USEM: {}"
+    if exclude != "examples":
+        inputForPrompt += "EXAMPLE: {}"
+    if exclude != "templates":
+        inputForPrompt += "CONCEPT: {}\n"
+    return inputForPrompt.format(sense.usem, sense.example, sense.template)
+
+
+def lemma_generation_chain(llm: BaseChatModel, layout: str = "inline", senses: int = 1) -> tuple[PydanticOutputParser, Runnable]:
+    """Returns the output parser and the chain prepending the LemmaDefs format instructions to the prompt,
+    or sending them with the static instructions as system message in the prefix layout.
+    The output limit of the model, if any, is scaled to the senses of the prompt"""
+    return structured_chain(scale_output_limit(llm, senses), pydantic_models.LemmaDefs, system_prompt("lemma") if layout == "prefix" else None)
+
+
+def store_lemma_definitions(parser: PydanticOutputParser, out_resp, prompt_text: str, senses: list[UsemEntry],
+                            modelname: str, modelname_short: str, journal: Journal|LexiconStore|None=None,
+                            stats: ModelStats|None=None) -> list[UsemEntry]:
+    """Parses the response to a lemma prompt and stores the definition of each sense
+
+    Parameters:
+        parser (PydanticOutputParser): LemmaDefs parser
+        out_resp: LLM response
+        prompt_text (str): lemma prompt
+        senses (list[UsemEntry]): senses defined by the lemma prompt
+        modelname (str): name of the model used for generation
+        modelname_short (str): name of the model used in the log files
+        journal (Journal|LexiconStore): journal of the run, or the store saving each definition, no journal if None
+        stats (ModelStats): counts the responses discarded by the parser
+
+    Returns:
+        missing (list[UsemEntry]): senses without a definition in the response, to be defined one by one
+    """
+    try:
+        parsed_out = parser.invoke(out_resp)
+    except OutputParserException as e:
+        print("*** Error parsing lemma output: {}".format(out_resp))
+        if stats is not None:
+            stats.record_parse_failure(out_resp)
+        with  open("output/errors/error-{}.json".format(modelname_short), 'a', encoding="utf-8") as error_file:
+            error_file.write("{}: ".format(str(e)))
+            error_file.write("PROMPT: {}\n".format(prompt_text))
+        return senses
+    definitions = {}
+    for usem_def in parsed_out.definitions:
+        definitions.setdefault(usem_def.usem.strip(), usem_def.definition)
+    missing = []
+    for sense in senses:
+        definition = definitions.get(sense.usem, definitions.get(sense.usem.split('#')[-1]))
+        if definition:
+            store_ai_definition(sense, modelname, definition, journal)
+        else:
+            missing.append(sense)
+    if missing:
+        print("No definition for {} in the lemma response, generate them one by one".format([sense.usem for sense in missing]))
+    return missing
+
+
+def generation_chain(llm: BaseChatModel, layout: str = "inline") -> tuple[PydanticOutputParser, Runnable]:
+    """Returns the output parser and the chain prepending the DefOnly format instructions to the prompt,
+    or sending them with the static instructions as system message in the prefix layout"""
+    return structured_chain(llm, pydantic_models.DefOnly, system_prompt("generation") if layout == "prefix" else None)
+
+
+def parse_definition(parser: PydanticOutputParser, out_resp, prompt_text: str, sense: UsemEntry, modelname_short: str,
+                     stats: ModelStats|None=None) -> pydantic_models.DefOnly|None:
+    """Parses the LLM response, logging it in the model error file if invalid and counting it in stats
+
+    Returns:
+        parsed_out (DefOnly|None): parsed definition, None if the response is invalid
+    """
+    try:
+        print ("OUT_RESP: {}".format(out_resp))
+        return parser.invoke(out_resp)
+    except OutputParserException as e:
+        print("*** Error parsing output: {}".format(out_resp)) #TODO aggiungi gestione errore
+        if stats is not None:
+            stats.record_parse_failure(out_resp)
+        with  open("output/errors/error-{}.json".format(modelname_short), 'a', encoding="utf-8") as error_file:
+            error_file.write("{}: ".format(str(e)))
+            error_file.write("PROMPT: {}\n".format(prompt_text))
+            error_file.write("SENSE: {}\n".format(json.dumps(sense.to_dict())))
+            error_file.flush()
+        return None
+
+
+def store_ai_definition(sense: UsemEntry, modelname: str, definition: str, journal: Journal|LexiconStore|None=None):
+    """Stores the definition generated by a model, overwriting the previous one by the same model, and journals it"""
+    indice = next((i for i, d in enumerate(sense.ai_definitions) if d.model == modelname), None)
+
+    if indice is not None:
+        print("\nDefinition created by {} already present. Overwrite it".format(modelname))
+        sense.ai_definitions[indice] = AIDefinition(modelname, definition, [], 0.0)
+    else: # altrimenti la inserisco
+        sense.ai_definitions.append(AIDefinition(modelname, definition, [], 0.0))
+    if journal is not None:
+        journal.record_definition(sense.usem, modelname, definition)
+
+
+def cached_prompt(prompt_cache: dict|None, key: tuple, build: Callable[[], str]) -> str:
+    """Returns the prompt stored in prompt_cache with key, building and storing it if missing
+
+    Parameters:
+        prompt_cache (dict): prompts already built, no cache if None
+        key (tuple): context_key of the sense, or the context keys of the senses of a lemma prompt
+        build (Callable[[], str]): builds the prompt
+
+    Returns:
+        prompt_text (str): the prompt
+    """
+    if prompt_cache is None:
+        return build()
+    if key not in prompt_cache:
+        prompt_cache[key] = build()
+    return prompt_cache[key]
+
+
+def log_prompt(promptNum: int, prompt_text: str):
+    with open("./prompts.txt","a") as prompt_file:
+        prompt_file.write("*** Prompt {} ***\n{}\n".format(promptNum, prompt_text))
+        prompt_file.flush()
+
+
+def generate_definitions(lexical_entries: Iterable[LexicalEntry], isAllSenses: bool, modelname: str, 
                          llm: BaseChatModel, exclude: str, overwriteGeneration: bool=False,
-                         ):
-    parser = PydanticOutputParser(pydantic_object=pydantic_models.DefOnly)
-    system_role = "Sei un esperto lessicografo.\n"
+                         perLemma: bool=False, stats: ModelStats|None=None, prompt_cache: dict|None=None,
+                         journal: Journal|LexiconStore|None=None, layout: str="inline", keep: bool=True) -> list[LexicalEntry]:
+    parser, prompt_and_model = generation_chain(llm, layout)
+    lemma_parser = output_parser(pydantic_models.LemmaDefs)
+    limiter = getattr(llm, "rate_limiter", None)
     # test = []
     timestr = time.strftime("%Y%m%d-%H%M%S")
     modelname_short = modelname.split('/')[-1]
 
     output_filename = 'output/llm_defs-{}.txt'.format(modelname_short)
     with open(output_filename,'w') as output:
-        progress_bar_le = tqdm(desc="Lexical entries",total=len(lexical_entries),leave=True)
+        progress_bar_le = tqdm(desc="Lexical entries",total=len(lexical_entries) if isinstance(lexical_entries, Sized) else None,leave=True)
         promptNum = 0
+        generated: list[LexicalEntry] = []
         for lexical_entry in lexical_entries:
+            if keep:
+                generated.append(lexical_entry)
             output.write("\n*** LEMMA: {} ***\n".format(lexical_entry.lemma))
             if not isAllSenses:
-                definition_limits = """
-Rispondi esclusivamente con JSON valido conforme allo schema fornito.
-Non aggiungere testo, spiegazioni o formattazione extra.
-La definizione non deve superare le 30 parole.
-Non riscrivere WORD nella definizione.
-Integra queste informazioni con la tua conoscenza interna per generare la definizione.\n"""
-                generation_desc = "Genera la definizione del senso della WORD data utilizzando le seguenti informazioni, dove:\n"
-                word_incipit = "La WORD è \"{}\":\n".format(lexical_entry.lemma)
-
                 progress_bar_senses = tqdm(desc="Senses", total=len(lexical_entry.senses), leave=False)
+                pending = []
                 for sense in lexical_entry.senses:
-                    indice = next((i for i, d in enumerate(sense.ai_definitions) if d.model == modelname), None)
-                    #check if definition generated by "modelname" is already present. If yes it will be overwritten
-                    if indice is None or (indice is not None and overwriteGeneration):
-                        inputForPrompt = "USEM: {}"
-                        if exclude != "examples":
-                            inputForPrompt += "EXAMPLE: {}"
-                        if exclude != "templates":
-                            inputForPrompt += "CONCEPT: {}\n"
-                        output.write(inputForPrompt.format(sense.usem, sense.example, sense.template))
-                        information_desc = ""
-                        sense_desc = ""
-                        #print("EXCLUDE: {}".format(exclude))
-                        if sense.example and exclude != "examples":
-                            information_desc+="- EXAMPLE: è l'esempio di uso della parola con quel senso\n"
-                            sense_desc+="EXAMPLE: {}\n".format(sense.example)
-                        if sense.template and exclude != "templates":
-                            information_desc+="- CONCEPT: è il concetto cui fa riferimento il senso della parola\n"
-                            sense_desc+="CONCEPT: {}\n".format(sense.template)
-                        if sense.relations and exclude != "relations":
-                            information_desc+="- RELATIONS: è un lista di relazioni con altre parole di cui è data la definizione\n"
-                            relations_list = []
-                            for rel in sense.relations:
-                                #print("REL {} : {}".format(rel.type, rel.lemma))
-                                convertedRelation = format_relation(lexical_entry.lemma,rel)
-                                if (convertedRelation is not None):
-                                    expl = "- {}".format(format_relation(lexical_entry.lemma,rel))
-                                    relations_list.append(expl)
-                            if len(relations_list) > 0:
-                                sense_desc+="RELATIONS: {}\n".format(";\n".join(relations_list))
-                            else:
-                                print("No useful relation for {}".format(sense.usem))
-                        prompt_text = system_role + generation_desc + information_desc + definition_limits + word_incipit + sense_desc
-                        struct_prompt = PromptTemplate(
-                            template="{format_instructions}\n{query}",
-                            input_variables=["query"],
-                            partial_variables={"format_instructions":parser.get_format_instructions()}
-                        )
-                        prompt_and_model = struct_prompt|llm
-                        with open("./prompts.txt","a") as prompt_file:
-                            promptNum += 1
-                            prompt_file.write("*** Prompt {} ***\n{}\n".format(promptNum, prompt_text))
-                            prompt_file.flush()
-                        #continue
-                        llm_start = time.time()
-                        out_resp = prompt_and_model.invoke({"query":prompt_text})
-                        llm_stop = time.time()
-                        try:
-                            print ("OUT_RESP: {}".format(out_resp))
-                            parsed_out = parser.invoke(out_resp)
-                        except OutputParserException as e:
-                            print("*** Error parsing output: {}".format(out_resp)) #TODO aggiungi gestione errore
-                            with  open("output/errors/error-{}.json".format(modelname_short), 'a', encoding="utf-8") as error_file:
-                                error_file.write("{}: ".format(str(e)))
-                                error_file.write("PROMPT: {}\n".format(prompt_text))
-                                error_file.write("SENSE: {}\n".format(json.dumps(sense.to_dict())))
-                                error_file.flush()
-                            continue
-
-                        indice = next((i for i, d in enumerate(sense.ai_definitions) if d.model == modelname), None)
-
-                        if indice is not None:
-                            print("\nDefinition created by {} already present. Overwrite it".format(modelname))
-                            sense.ai_definitions[indice] = AIDefinition(modelname, parsed_out.definition, [], 0.0)
-                        else: # altrimenti la inserisco
-                            sense.ai_definitions.append(AIDefinition(modelname, parsed_out.definition, [], 0.0))
-                        output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format((llm_stop - llm_start),llm.invoke(prompt_text).content))
-                        output.flush()
-                        progress_bar_senses.update()
+                    if needs_generation(sense, modelname, overwriteGeneration):
+                        pending.append(sense)
                     else:
                         print("\nDefinition already present. Skip.")
+                if perLemma and len(pending) > 1:
+                    prompt_text = cached_prompt(prompt_cache, tuple(context_key(lexical_entry.lemma, sense) for sense in pending),
+                                                lambda: build_lemma_prompt(lexical_entry.lemma, pending, exclude, layout))
+                    promptNum += 1
+                    log_prompt(promptNum, prompt_text)
+                    _, lemma_prompt_and_model = lemma_generation_chain(llm, layout, len(pending))
+                    llm_start = time.time()
+                    out_resp = invoke_with_backoff(lemma_prompt_and_model, {"query":prompt_text}, limiter)
+                    llm_stop = time.time()
+                    if stats is not None:
+                        stats.record(llm_stop - llm_start, out_resp, len(pending))
+                    missing = store_lemma_definitions(lemma_parser, out_resp, prompt_text, pending, modelname, modelname_short, journal, stats)
+                    output.write("USEM: {}\n".format(", ".join(sense.usem for sense in pending)))
+                    output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format((llm_stop - llm_start),out_resp.content))
+                    output.flush()
+                    progress_bar_senses.update(len(pending) - len(missing))
+                    pending = missing
+                for sense in pending:
+                    output.write(sense_log_header(sense, exclude))
+                    prompt_text = cached_prompt(prompt_cache, context_key(lexical_entry.lemma, sense),
+                                                lambda: build_generation_prompt(lexical_entry.lemma, sense, exclude, layout))
+                    promptNum += 1
+                    log_prompt(promptNum, prompt_text)
+                    #continue
+                    llm_start = time.time()
+                    out_resp = invoke_with_backoff(prompt_and_model, {"query":prompt_text}, limiter)
+                    llm_stop = time.time()
+                    if stats is not None:
+                        stats.record(llm_stop - llm_start, out_resp)
+                    parsed_out = parse_definition(parser, out_resp, prompt_text, sense, modelname_short, stats)
+                    if parsed_out is None:
+                        continue
+                    store_ai_definition(sense, modelname, parsed_out.definition, journal)
+                    output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format((llm_stop - llm_start),out_resp.content))
+                    output.flush()
+                    progress_bar_senses.update()
         # print(test)
             progress_bar_le.update()
     #error_file.close()
-    return lexical_entries
+    return generated
+
+
+async def agenerate_definitions(lexical_entries: Iterable[LexicalEntry], modelname: str, llm: BaseChatModel,
+                                exclude: str, overwriteGeneration: bool=False, concurrency: int=8,
+                                perLemma: bool=False, stats: ModelStats|None=None, prompt_cache: dict|None=None,
+                                journal: Journal|LexiconStore|None=None, layout: str="inline", keep: bool=True) -> list[LexicalEntry]:
+    """Generates the definitions with up to concurrency requests in flight
+
+    Lexical entries are consumed from lexical_entries in a worker thread, so a blocking iterator
+    (e.g. the --stream pipeline) does not stall the requests in flight. Responses are stored in the
+    senses and logged in the same order of the sequential generate_definitions. At most concurrency lexical
+    entries are scheduled ahead of the one being stored.
+
+    Parameters:
+        lexical_entries (Iterable[LexicalEntry]): lexical entries to be defined
+        modelname (str): name of the model used for generation
+        llm (BaseChatModel): chat model
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        overwriteGeneration (bool): overwrite the definitions already generated by the model
+        concurrency (int): max number of requests in flight
+        perLemma (bool): define all the senses of a lemma with a single request
+        stats (ModelStats): collects the duration of each request
+        prompt_cache (dict): prompts already built, shared by the runs of different models on the same lexical entries
+        journal (Journal|LexiconStore): journal of the run, or the store saving each definition, no journal if None
+        layout (str): prompt layout, one of PROMPT_LAYOUTS
+        keep (bool): return the lexical entries. If False (the LexiconStore saves each definition) they are
+            released once defined, so the memory does not grow with the lexicon
+
+    Returns:
+        lexical_entries (list[LexicalEntry]): the lexical entries with the generated definitions, empty if not keep
+    """
+    parser, prompt_and_model = generation_chain(llm, layout)
+    lemma_parser = output_parser(pydantic_models.LemmaDefs)
+    limiter = getattr(llm, "rate_limiter", None)
+    modelname_short = modelname.split('/')[-1]
+    semaphore = asyncio.Semaphore(concurrency)
+    #bounded: the scheduler waits for the lexical entries to be consumed, so only about concurrency entries
+    #(their prompts and request tasks) are held in memory and the --stream backpressure is kept
+    scheduled: asyncio.Queue = asyncio.Queue(maxsize=max(1, concurrency))
+    progress_bar_le = tqdm(desc="Lexical entries",total=len(lexical_entries) if isinstance(lexical_entries, Sized) else None,leave=True)
+    progress_bar_senses = tqdm(desc="Senses", total=0, leave=False)
+    promptNum = 0
+
+    async def invoke(chain: Runnable, prompt_text: str, senses: int = 1):
+        async with semaphore:
+            llm_start = time.time()
+            out_resp = await ainvoke_with_backoff(chain, {"query":prompt_text}, limiter)
+            llm_stop = time.time()
+        if stats is not None:
+            stats.record(llm_stop - llm_start, out_resp, senses)
+        if senses == 1:
+            progress_bar_senses.update()
+        return out_resp, llm_stop - llm_start
+
+    def schedule_sense(lemma: str, sense: UsemEntry) -> tuple:
+        nonlocal promptNum
+        prompt_text = cached_prompt(prompt_cache, context_key(lemma, sense), lambda: build_generation_prompt(lemma, sense, exclude, layout))
+        promptNum += 1
+        log_prompt(promptNum, prompt_text)
+        return sense, prompt_text, asyncio.create_task(invoke(prompt_and_model, prompt_text))
+
+    async def schedule():
+        nonlocal promptNum
+        entries = iter(lexical_entries)
+        try:
+            while (lexical_entry := await asyncio.to_thread(next, entries, None)) is not None:
+                pending = []
+                for sense in lexical_entry.senses:
+                    if needs_generation(sense, modelname, overwriteGeneration):
+                        pending.append(sense)
+                    else:
+                        print("\nDefinition already present. Skip.")
+                progress_bar_senses.total += len(pending)
+                progress_bar_senses.refresh()
+                lemma_request = None
+                sense_requests = []
+                if perLemma and len(pending) > 1:
+                    prompt_text = cached_prompt(prompt_cache, tuple(context_key(lexical_entry.lemma, sense) for sense in pending),
+                                                lambda: build_lemma_prompt(lexical_entry.lemma, pending, exclude, layout))
+                    promptNum += 1
+                    log_prompt(promptNum, prompt_text)
+                    _, lemma_prompt_and_model = lemma_generation_chain(llm, layout, len(pending))
+                    lemma_request = (pending, prompt_text, asyncio.create_task(invoke(lemma_prompt_and_model, prompt_text, len(pending))))
+                else:
+                    sense_requests = [schedule_sense(lexical_entry.lemma, sense) for sense in pending]
+                await scheduled.put((lexical_entry, lemma_request, sense_requests))
+        finally:
+            await scheduled.put(None)
+
+    scheduler = asyncio.create_task(schedule())
+    generated: list[LexicalEntry] = []
+    with open('output/llm_defs-{}.txt'.format(modelname_short),'w') as output:
+        while (item := await scheduled.get()) is not None:
+            lexical_entry, lemma_request, sense_requests = item
+            if keep:
+                generated.append(lexical_entry)
+            output.write("\n*** LEMMA: {} ***\n".format(lexical_entry.lemma))
+            if lemma_request is not None:
+                senses, prompt_text, request = lemma_request
+                out_resp, elapsed = await request
+                missing = store_lemma_definitions(lemma_parser, out_resp, prompt_text, senses, modelname, modelname_short, journal, stats)
+                output.write("USEM: {}\n".format(", ".join(sense.usem for sense in senses)))
+                output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format(elapsed, out_resp.content))
+                output.flush()
+                progress_bar_senses.update(len(senses) - len(missing))
+                sense_requests = [schedule_sense(lexical_entry.lemma, sense) for sense in missing]
+            for sense, prompt_text, request in sense_requests:
+                output.write(sense_log_header(sense, exclude))
+                out_resp, elapsed = await request
+                parsed_out = parse_definition(parser, out_resp, prompt_text, sense, modelname_short, stats)
+                if parsed_out is None:
+                    continue
+                store_ai_definition(sense, modelname, parsed_out.definition, journal)
+                output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format(elapsed, out_resp.content))
+                output.flush()
+            progress_bar_le.update()
+    await scheduler
+    return generated
+
+
+def generate_matrix(lexicons: dict[str, list[LexicalEntry]], modelname: str, llm: BaseChatModel,
+                    overwriteGeneration: bool=False, stats: ModelStats|None=None,
+                    journals: dict[str, Journal]|None=None, layout: str="inline") -> dict[str, list[LexicalEntry]]:
+    """Generates the definitions for many ablation modes, sending each distinct prompt only once
+
+    A sense often gets a byte-identical prompt in different modes (e.g. -x examples on a sense without
+    example): the definition generated for that prompt is stored in the sense of every such mode.
+
+    Parameters:
+        lexicons (dict[str, list[LexicalEntry]]): lexical entries of each ablation mode (see EXCLUDE_MODES)
+        modelname (str): name of the model used for generation
+        llm (BaseChatModel): chat model
+        overwriteGeneration (bool): overwrite the definitions already generated by the model
+        stats (ModelStats): collects the duration of each request
+        journals (dict[str, Journal]): journal of each ablation mode, no journal if None
+        layout (str): prompt layout, one of PROMPT_LAYOUTS
+
+    Returns:
+        lexicons (dict[str, list[LexicalEntry]]): the same lexicons with the generated definitions
+    """
+    parser, prompt_and_model = generation_chain(llm, layout)
+    limiter = getattr(llm, "rate_limiter", None)
+    modelname_short = modelname.split('/')[-1]
+    requests: dict[str, list[tuple[str, UsemEntry]]] = {}
+    senses = 0
+    for mode, lexical_entries in lexicons.items():
+        for lexical_entry in lexical_entries:
+            for sense in lexical_entry.senses:
+                if needs_generation(sense, modelname, overwriteGeneration):
+                    #the sense context is rendered once and shared by all the modes
+                    prompt_text = build_generation_prompt(lexical_entry.lemma, sense, mode_exclude(mode), layout)
+                    requests.setdefault(prompt_text, []).append((mode, sense))
+                    senses += 1
+    print("Generation matrix: {} distinct prompts for {} senses in {} modes".format(len(requests), senses, len(lexicons)))
+
+    with open('output/llm_defs-{}-matrix.txt'.format(modelname_short),'w') as output:
+        promptNum = 0
+        for prompt_text, targets in tqdm(requests.items(), desc="Prompts", total=len(requests)):
+            promptNum += 1
+            log_prompt(promptNum, prompt_text)
+            llm_start = time.time()
+            out_resp = invoke_with_backoff(prompt_and_model, {"query":prompt_text}, limiter)
+            llm_stop = time.time()
+            if stats is not None:
+                stats.record(llm_stop - llm_start, out_resp)
+            output.write("USEM: {} MODES: {}\n".format(targets[0][1].usem, ", ".join(mode for mode, _ in targets)))
+            parsed_out = parse_definition(parser, out_resp, prompt_text, targets[0][1], modelname_short, stats)
+            if parsed_out is None:
+                continue
+            for mode, sense in targets:
+                store_ai_definition(sense, modelname, parsed_out.definition, journals[mode] if journals else None)
+            output.write("*** RESPONSE:*** execution time: {:.2f}s\n{}\n".format((llm_stop - llm_start),out_resp.content))
+            output.flush()
+    return lexicons
+
+
+def parse_output_limit(spec: str) -> tuple[str|None, int]:
+    """Parses a --max-output-tokens value: N, auto (the budget of a definition of DEFINITION_MAX_WORDS words)
+    or MODEL=N|auto for the limit of a single model, e.g. gemma3:12b=auto
+
+    Returns:
+        limit (tuple[str|None, int]): model name (None for the default of the models) and max output tokens
+    """
+    modelname, sep, value = spec.rpartition("=")
+    if sep and not modelname:
+        raise argparse.ArgumentTypeError("max output tokens must be N, auto or MODEL=N|auto")
+    if value == "auto":
+        return (modelname or None), definition_token_budget()
+    try:
+        return (modelname or None), int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("max output tokens must be N, auto or MODEL=N|auto, not {}".format(spec))
+
+
+def output_limit(limits: list[tuple[str|None, int]]|None, modelname: str) -> int|None:
+    """Returns the max output tokens of a model: its own limit if given, else the default limit, None if neither"""
+    limits = dict(limits or [])
+    return limits.get(modelname, limits.get(None))
 
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--load', action="store_true", help="If to load data from pickle")
-    parser.add_argument('-m', '--modelname', type=str, help="Name of the model to be used")
+    parser.add_argument('-m', '--modelname', type=str, nargs="+", help="Name of the models to be used. Many models are run one after the other on the same lexical entries")
     parser.add_argument('-k', "--remove", type=bool, action=argparse.BooleanOptionalAction, help="Remove all the definitions generated by model specified by -m|--modelname from the pickel file")
     parser.add_argument('-o', '--output', type=str, help="path/filename for the json computed output")
-    parser.add_argument('-p', "--pickle", type=str, help="Path to the pickle file")
+    parser.add_argument('-p', "--pickle", type=str, help="Path to the pickle file, or to a SQLite lexicon store if it ends with .sqlite or .db")
     parser.add_argument('-w', "--overwrite", type=bool, action=argparse.BooleanOptionalAction, help="Overwrite definitions already generated by model specified by -m|--modelname")
     parser.add_argument('-r', '--remote', type=str, help="Remote service to use LLM modelname")
     parser.add_argument('-x', '--exclude',  type=str, help="Exclude relation, examples or both in definition generation: [relations|examples|templates]")
     parser.add_argument("--lev1", type=str, help="Path to level 1 query, for senses retrieval")
     parser.add_argument("--lev2", type=str, help="Path to level 2 query, for relations retrieval")
+    parser.add_argument("--json", type=str, help="Read the lexical entries lazily from a CompL-it json/JSONL export (optionally .gz/.zst) instead of the SPARQL endpoint. With a SQLite store as -p the memory does not grow with the export, with a pickle the lexical entries are kept in memory to be saved")
+    parser.add_argument("--batch-size", type=int, default=50, help="Number of senses whose relations are retrieved with a single level 2 query")
+    parser.add_argument("--sparql-workers", type=int, default=4, help="Number of level 2 queries executed concurrently")
+    parser.add_argument("--sparql-cache", type=str, default="off", choices=CACHE_MODES, help="On-disk cache of SPARQL results: off, on (read and write), refresh (write only), offline (read only)")
+    parser.add_argument("--sparql-cache-dir", type=str, default="data/sparql_cache", help="Directory of the SPARQL cache")
+    parser.add_argument("--sparql-cache-ttl", type=float, help="Hours after which a cached SPARQL result expires")
+    parser.add_argument("--sparql-cache-max-mb", type=float, help="Max size of the SPARQL cache in MB, least recently used results are evicted")
+    parser.add_argument("--sync", action="store_true", help="Refresh the lexical entries of -p against the SPARQL endpoint, retrieving the relations only of the new or changed senses. Unchanged senses keep their AI definitions")
+    parser.add_argument("--stream", action="store_true", help="Start the generation while the lexical entries are still being retrieved")
+    parser.add_argument("--page-size", type=int, default=1000, help="Number of level 1 rows retrieved with a single query in --stream mode")
+    parser.add_argument("--queue-size", type=int, default=100, help="Max number of lexical entries retrieved and waiting for the generation in --stream mode")
+    parser.add_argument("--concurrency", type=int, default=1, help="Max number of generation requests in flight. Values greater than 1 use the asynchronous generation")
+    parser.add_argument("--per-lemma", action="store_true", help="Generate the definitions of all the senses of a lemma with a single request")
+    parser.add_argument("--matrix", type=str, nargs="+", choices=EXCLUDE_MODES, help="Ablation modes generated in a single pass, sharing identical prompts. Pickle and output of each mode get the mode as suffix")
+    parser.add_argument("--keep-alive", type=parse_keep_alive, default="30m", help="How long a local model stays loaded in the Ollama server after the last request: a duration (e.g. 30m, 24h) or seconds (e.g. 3600, -1 forever)")
+    parser.add_argument("--pin-model", action="store_true", help="Keep a local model loaded for the whole run of the model (keep alive forever), unloading it at the end of the run. Replaces --keep-alive")
+    parser.add_argument("--ollama-hosts", type=str, nargs="+", help="Base urls of the Ollama servers sharing the requests of a local model (e.g. http://gpu1:11434 http://gpu2:11434). The model is warmed up on all of them")
+    parser.add_argument("--balance", type=str, default="least-loaded", choices=POOL_STRATEGIES, help="Dispatch of the requests to the --ollama-hosts: least-loaded (fewest requests in flight) or round-robin")
+    parser.add_argument("--llm-cache", type=str, help="Path to the SQLite store of the LLM responses. Identical prompts are sent to the model only once")
+    parser.add_argument("--llm-cache-max-entries", type=int, help="Max number of responses in the LLM cache, least recently used are evicted")
+    parser.add_argument("--prompt-layout", type=str, default="inline", choices=PROMPT_LAYOUTS, help="inline: instructions and sense data in the same message; prefix: static instructions in a system message identical for all the requests (reused by the prompt caches), sense data last")
+    parser.add_argument("--journal-compact-every", type=int, default=500, help="Number of generated definitions after which the pickle is saved and its journal emptied")
+    parser.add_argument("--relation-filters", type=str, default=RELATION_FILTERS_PATH, help="Json config of the relation types and targets excluded by the SPARQL queries (#FILTERS# placeholder) and by the pruning")
+    parser.add_argument("--structured-output", type=bool, action=argparse.BooleanOptionalAction, help="Constrained decoding of the responses: Ollama JSON schema format, JSON mode for the remote models")
+    parser.add_argument("--max-output-tokens", type=parse_output_limit, nargs="+", help="Output token limit of the responses (Ollama num_predict, max_tokens of the remote models): N, auto (derived from the word limit of the definitions) or MODEL=N|auto for a single model. Scaled by the senses of the --per-lemma prompts. Reasoning models need an explicit N covering the reasoning")
+    parser.add_argument("--early-stop", action="store_true", help="Stream the responses and stop each one as soon as its JSON object is complete")
+    parser.add_argument("--rate-limits", type=str, default=PROVIDER_LIMITS_PATH, help="Json config of the requests (rpm) and tokens (tpm) per minute of each REMOTE or REMOTE:MODEL")
+    parser.add_argument("--relation-types", type=str, default=RELATION_TYPES_PATH, help="Json config mapping each relation type URI to its Italian description in the prompts (null to leave the type out)")
     args = parser.parse_args()
+    load_relation_types(args.relation_types)
+    configure_relation_filters(args.relation_filters)
+    configure_rate_limits(args.rate_limits)
 
-
-    ####### RELAZIONI DA ESCLUDE #########
-    excludedRelationsWithUsem = {"http://lexica/mylexicon#USem796entita1",
-                         }
-    excludedRelationsType = {"http://klab/lexicon/vocabulary/compl-it#formal",
-                         "http://klab/lexicon/vocabulary/compl-it#isA",
-                         "http://klab/lexicon/vocabulary/compl-it#synonym"
-                         }
-   
     if args.exclude and args.exclude not in ["relations","examples","templates"]:
         print("Exclude must have one of this string value 'relations' ,'examples' or 'both'")
         sys.exit(-1)
@@ -262,47 +797,75 @@ def main():
     else:
         raise(FileNotFoundError("You have to specify json output file using -o|--output flag. Example -o output/generated_defs.json"))
   
-    if args.load: # -l means load the already retrieved data 
-        with open(args.pickle,'rb') as data_file:
-            lexical_entries = pickle.load(data_file, encoding="utf-8")
+    store = LexiconStore(args.pickle) if is_lexicon_store(args.pickle) and not args.matrix else None
+    if args.load and store is not None:
+        lexical_entries = [] #the senses to be defined are selected by the store for each model
+    elif args.load and args.matrix and all(os.path.exists(mode_path(args.pickle, mode)) for mode in args.matrix):
+        lexical_entries = [] #every mode resumes from its own lexicon
+    elif args.load: # -l means load the already retrieved data 
+        lexical_entries = load_lexicon(args.pickle)
+    elif args.json:
+        lexical_entries = iter_json_complit(args.json)
+        if store is not None:
+            lexical_entries = store.saving(lexical_entries)
     else:
-        lexical_entries = first_level_query(args.lev1)
+        cache = None
+        if args.sparql_cache != "off":
+            cache = SparqlCache(cache_dir=args.sparql_cache_dir, mode=args.sparql_cache,
+                                ttl=args.sparql_cache_ttl * 3600 if args.sparql_cache_ttl else None,
+                                max_size_mb=args.sparql_cache_max_mb)
+        configure_sparql_client(max_workers=args.sparql_workers, cache=cache)
+        if args.sync:
+            if not args.lev2 or not args.pickle:
+                print("--sync requires the level 2 query --lev2 and the lexicon to refresh -p")
+                sys.exit(-1)
+            stored = []
+            if store is not None:
+                stored = store.load()
+            elif os.path.exists(args.pickle):
+                stored = load_lexicon(args.pickle)
+            lexical_entries = sync_lexical_entries(stored, args.lev1, args.lev2, args.batch_size)
+            if store is None:
+                save_to_pickle(args.pickle, lexical_entries)
+        elif args.stream:
+            if not args.lev2:
+                print("--stream requires the level 2 query --lev2")
+                sys.exit(-1)
+            lexical_entries = queue_lexical_entries(stream_lexical_entries(args.lev1, args.lev2, args.page_size, args.batch_size),
+                                                    args.queue_size)
+        else:
+            lexical_entries = first_level_query(args.lev1)
         #print("Retrieved {} lexical entries".format(len(lexical_entries)))
-        if(args.lev2):
-            howManySenses = 0
-            for le in lexical_entries[:]:
-                for sense in le.senses[:]:
-                    sense.relations = second_level_query(input_path=args.lev2, sense_id=sense.usem)
-                    #print("\tRetrieved {} senses for {}".format(len(sense.relations), sense.usem))
-                    for x in sense.relations[:]: #notazione per rimuovere elementi del vettore sul quale sto iterando
-                        #print("\tRelation: '{}' '{}'".format(x.type, x.usem))
-
-                        if x.usem in excludedRelationsWithUsem:
-                            sense.relations.remove(x)
-                            #print("\t\tremove1 '{}' '{}'".format(x.type, x.usem))
-                        elif x.type in excludedRelationsType:
-                            sense.relations.remove(x)
-                            #print("\t\tremove2 '{}' '{}'".format(x.type, x.usem))
-                        elif x.type == "http://klab/lexicon/vocabulary/compl-it#hasSemanticType": #relazione del template => la elimino
-                            sense.relations.remove(x)
-                            #print("\t\tremove template: '{}' '{}'".format(x.type, x.usem))
-                        #else:
-                        #    print("\tRelation ok: '{}' '{}'".format(x.type, x.usem))
-                    if len(sense.relations) == 0:
-                        print("Removing Sense {} because have not usefull relations".format(sense.usem))
-                        le.senses.remove(sense)
-                    #print("\tAfter pruning {} senses for {}\n".format(len(sense.relations), sense.usem))
-                if (len(le.senses) == 0):
-                    print("Removing {} lexical entry".format(le.lemma))
-                    lexical_entries.remove(le)
-                else:
-                    howManySenses += len(le.senses)
+        if(args.lev2 and not args.stream and not args.sync):
+            relationsBySense = second_level_query_batch(input_path=args.lev2,
+                                                        sense_ids=[sense.usem for le in lexical_entries for sense in le.senses],
+                                                        batch_size=args.batch_size)
+            for le in lexical_entries:
+                for sense in le.senses:
+                    sense.relations = relationsBySense[sense.usem]
+            lexical_entries = [le for le in lexical_entries if prune_lexical_entry(le)]
+            howManySenses = sum(len(le.senses) for le in lexical_entries)
             print("Total Lexical Entries: {}".format(len(lexical_entries)))
             print("Total Sense: {}".format(howManySenses))
-
+        if store is not None:
+            if isinstance(lexical_entries, list):
+                store.save(lexical_entries)
+            else:
+                lexical_entries = store.saving(lexical_entries)
+
+    journal = None
+    if args.pickle and not args.matrix and store is None: #definitions of an interrupted run are replayed from the journal, so their senses are skipped
+        journal = Journal(journal_path(args.pickle), compact_every=args.journal_compact_every,
+                          on_compact=(lambda: save_to_pickle(args.pickle, lexical_entries)) if isinstance(lexical_entries, list) else None)
+        lexical_entries = list(journal.replay(lexical_entries)) if isinstance(lexical_entries, list) else journal.replay(lexical_entries)
+
+    if args.remove and store is not None:
+        for model in args.modelname or []:
+            print("Removed {} definitions generated by {}".format(store.remove_definitions(model), model))
+        store.close()
+        sys.exit(0)
     if args.remove:
-        if args.modelname:
-            model =  args.modelname
+        for model in args.modelname or []:
             for le in lexical_entries:
                 for sense in le.senses:
                     for definition in sense.ai_definitions[:]:
@@ -317,13 +880,88 @@ def main():
         print("Ended retrieving lexical entries and senses")
         #sys.exit(0)
 
-    modelname = args.modelname
-    llm = config_model(remote=args.remote,modelname=modelname,temperature=0)
-    les:list[LexicalEntry] = generate_definitions(lexical_entries,False,modelname,llm, args.exclude, overwriteGeneration)
-    save_to_pickle(args.pickle, les)
-    with open(outputFileName,'w', encoding="utf-8") as out_json:
-        encoded_out = json.dumps([le_def.to_dict() for le_def in les],ensure_ascii=False, indent=3)
-        out_json.write(encoded_out)
+    if not args.modelname:
+        print("You have to specify at least a model using -m|--modelname flag")
+        sys.exit(-1)
+    llm_cache = LLMCache(args.llm_cache, args.llm_cache_max_entries) if args.llm_cache else None
+    #prompts do not depend on the model: they are built once for all the models, unless the lexical entries are
+    #read lazily (--json, --stream) and the memory must not grow with the lexicon
+    prompt_cache: dict|None = {} if isinstance(lexical_entries, list) else None
+    models_stats: list[ModelStats] = []
+    keepAlive = -1 if args.pin_model else args.keep_alive
+    pool = OllamaPool(args.ollama_hosts, args.balance) if args.remote is None and args.ollama_hosts else None
+    les = lexical_entries
+    if args.matrix:
+        if isinstance(les, Iterator):
+            les = list(les)
+        lexicons: dict[str, list[LexicalEntry]] = {}
+        journals: dict[str, Journal] = {}
+        for mode in args.matrix:
+            if args.load and os.path.exists(mode_path(args.pickle, mode)):
+                lexicons[mode] = load_lexicon(mode_path(args.pickle, mode))
+            else:
+                lexicons[mode] = copy.deepcopy(les)
+            journals[mode] = Journal(journal_path(mode_path(args.pickle, mode)), compact_every=args.journal_compact_every,
+                                     on_compact=lambda mode=mode: save_lexicon(mode_path(args.pickle, mode), lexicons[mode]))
+            lexicons[mode] = list(journals[mode].replay(lexicons[mode]))
+    for model_idx, modelname in enumerate(args.modelname):
+        stats = ModelStats(modelname)
+        models_stats.append(stats)
+        if args.remote is None:
+            print("Loading model {}".format(modelname))
+            stats.load_time = pool.warm_up(modelname, keepAlive) if pool is not None else warm_up_model(modelname, keep_alive=keepAlive)
+        llm = config_model(remote=args.remote,modelname=modelname,temperature=0,cache=llm_cache,keep_alive=keepAlive,
+                           structured_output=bool(args.structured_output),
+                           max_tokens=output_limit(args.max_output_tokens, modelname), early_stop=args.early_stop, pool=pool)
+        if args.matrix:
+            generate_matrix(lexicons, modelname, llm, overwriteGeneration, stats=stats, journals=journals, layout=args.prompt_layout)
+            for mode, mode_les in lexicons.items():
+                save_lexicon(mode_path(args.pickle, mode), mode_les)
+                journals[mode].reset()
+        else:
+            if store is not None and (args.load or model_idx > 0):
+                les = store.iterate(lacking_definition=None if overwriteGeneration else modelname)
+            recorder = store if store is not None else journal #the store saves each definition with a single row upsert
+            if args.concurrency > 1:
+                les = asyncio.run(agenerate_definitions(les, modelname, llm, args.exclude,
+                                                        overwriteGeneration, args.concurrency, args.per_lemma,
+                                                        stats=stats, prompt_cache=prompt_cache, journal=recorder,
+                                                        layout=args.prompt_layout, keep=store is None))
+            else:
+                les = generate_definitions(les,False,modelname,llm, args.exclude, overwriteGeneration,
+                                           args.per_lemma, stats=stats, prompt_cache=prompt_cache, journal=recorder,
+                                           layout=args.prompt_layout, keep=store is None)
+            if store is None:
+                save_to_pickle(args.pickle, les)
+            if journal is not None:
+                journal.reset()
+        if args.remote is None and (args.pin_model or model_idx < len(args.modelname) - 1): #free the VRAM for the next model
+            if pool is not None:
+                pool.unload(modelname)
+            else:
+                unload_model(modelname)
+    if store is not None: #exported one batch of lexical entries at a time
+        les = store.iterate()
+    outputs = {mode_path(outputFileName, mode): mode_les for mode, mode_les in lexicons.items()} if args.matrix else {outputFileName: les}
+    for output_path, output_les in outputs.items():
+        write_lexicon(output_path, output_les)
+    if store is not None:
+        store.close()
+    if args.matrix:
+        for mode_journal in journals.values():
+            mode_journal.close()
+    elif journal is not None:
+        journal.close()
+    for stats in models_stats:
+        print(stats.report())
+    if pool is not None:
+        for line in pool.report():
+            print(line)
+    for limiter in rate_limiters.values():
+        print(limiter.report())
+    if llm_cache is not None:
+        print(llm_cache.report())
+        llm_cache.close()
 
 if __name__ == "__main__":
     try:
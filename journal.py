@@ -0,0 +1,137 @@
+from complit_generation import *
+from typing import Callable, Iterable, Iterator
+import json
+import os
+import threading
+
+
+class Journal:
+    """Append-only JSONL journal of the AI definitions and scores produced during a run
+
+    Each record is flushed as soon as it is written, so a crash loses at most the request in flight.
+    Every compact_every records the on_compact callback saves the whole lexicon (e.g. the pickle) and
+    the journal is emptied. On restart, replay applies the records to the saved lexicon.
+    """
+
+    def __init__(self, path: str, compact_every: int = 500, on_compact: Callable[[], None]|None = None, fsync: bool = False):
+        """Initialize the journal, appending to an existing one
+
+        Parameters:
+            path (str): path to the journal file
+            compact_every (int): number of records after which the lexicon is saved and the journal emptied
+            on_compact (Callable[[], None]): saves the whole lexicon, no compaction if None
+            fsync (bool): force each record to disk, surviving also OS crashes
+        """
+        self.path = path
+        self.compact_every = compact_every
+        self.on_compact = on_compact
+        self.fsync = fsync
+        self.records = 0
+        self.lock = threading.RLock()
+        self.file = open(path, 'a', encoding="utf-8")
+        if self.file.tell() > 0:
+            with open(path, 'rb') as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b"\n": #terminate the record truncated by a crash, it is skipped by read
+                    self.file.write("\n")
+
+
+    def write(self, record: dict):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.records += 1
+            if self.on_compact is not None and self.records >= self.compact_every:
+                self.compact()
+
+
+    def record_definition(self, usem: str, model: str, definition: str):
+        """Journals the definition of a sense generated by a model"""
+        self.write({"kind": "definition", "usem": usem, "model": model, "definition": definition})
+
+
+    def record_score(self, usem: str, definition_model: str, judge: str, score: int):
+        """Journals the score given by a judge to the definition of a sense generated by definition_model"""
+        self.write({"kind": "score", "usem": usem, "definition_model": definition_model, "judge": judge, "score": score})
+
+
+    def compact(self):
+        """Saves the whole lexicon with on_compact, then empties the journal. If the save fails the journal is kept,
+        on_compact must replace the saved lexicon atomically (see lexicon_store.save_pickle)"""
+        with self.lock:
+            if self.on_compact is not None:
+                self.on_compact()
+            self.reset()
+
+
+    def reset(self):
+        """Empties the journal, to be called once its records are saved in the lexicon"""
+        with self.lock:
+            self.file.close()
+            self.file = open(self.path, 'w', encoding="utf-8")
+            self.records = 0
+
+
+    def read(self) -> dict[str, list[dict]]:
+        """Returns the journal records grouped by sense identifier, in the order they were written"""
+        records: dict[str, list[dict]] = {}
+        with self.lock, open(self.path, 'r', encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: #last record truncated by a crash
+                    continue
+                records.setdefault(record["usem"], []).append(record)
+        return records
+
+
+    def replay(self, lexical_entries: Iterable[LexicalEntry]) -> Iterator[LexicalEntry]:
+        """Applies the journal records to the lexical entries as they are consumed
+
+        Parameters:
+            lexical_entries (Iterable[LexicalEntry]): lexical entries loaded from the last save, or being retrieved
+
+        Returns:
+            lexical_entries (Iterator[LexicalEntry]): the same lexical entries with the records applied
+        """
+        records = self.read()
+        for le in lexical_entries:
+            for sense in le.senses:
+                for record in records.get(sense.usem, []):
+                    if record["kind"] == "definition":
+                        apply_definition(sense, record["model"], record["definition"])
+                    else:
+                        apply_score(sense, record["definition_model"], record["judge"], record["score"])
+            yield le
+
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def apply_definition(sense: UsemEntry, model: str, definition: str):
+    """Stores the definition of a sense generated by a model, overwriting the previous one by the same model"""
+    indice = next((i for i, d in enumerate(sense.ai_definitions) if d.model == model), None)
+    if indice is not None:
+        sense.ai_definitions[indice] = AIDefinition(model, definition, [], 0.0)
+    else:
+        sense.ai_definitions.append(AIDefinition(model, definition, [], 0.0))
+
+
+def apply_score(sense: UsemEntry, definition_model: str, judge: str, score: int):
+    """Stores the score given by a judge to a definition of a sense, overwriting the previous one by the same judge"""
+    for ai_def in sense.ai_definitions:
+        if ai_def.model == definition_model:
+            indice = next((i for i, d in enumerate(ai_def.scores) if d.model == judge), None)
+            if indice is not None:
+                ai_def.scores[indice] = Score(model=judge, score=score)
+            else:
+                ai_def.scores.append(Score(model=judge, score=score))
+
+
+def journal_path(pickle_path: str) -> str:
+    """Returns the path of the journal of a pickle file"""
+    return pickle_path + ".journal"
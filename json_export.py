@@ -0,0 +1,90 @@
+from complit_generation import *
+from typing import IO, Iterable
+import contextlib
+import gzip
+import json
+import os
+
+
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+"""Extensions of the compressed outputs"""
+
+
+def export_format(path: str) -> tuple[str, str|None]:
+    """Infers the format of an output from its extension
+
+    Parameters:
+        path (str): path of the output, e.g. output/defs.json, output/defs.jsonl.gz, output/defs.json.zst
+
+    Returns:
+        format (str): jsonl for .jsonl files, json (indented array) otherwise
+        compression (str|None): gzip, zstd or None
+    """
+    stem, extension = os.path.splitext(path)
+    compression = COMPRESSIONS.get(extension)
+    if compression is not None:
+        extension = os.path.splitext(stem)[1]
+    return ("jsonl" if extension == ".jsonl" else "json"), compression
+
+
+def open_compressed(path: str, compression: str|None, mode: str = "wt") -> IO:
+    """Opens a file compressed with gzip or zstd, for writing text by default
+
+    Parameters:
+        path (str): path of the file
+        compression (str): gzip, zstd or None
+        mode (str): wt, rt or rb
+
+    Returns:
+        file (IO): the opened file
+    """
+    encoding = None if "b" in mode else "utf-8"
+    if compression == "gzip":
+        return gzip.open(path, mode, encoding=encoding)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstd compression requires the zstandard package: pip install zstandard")
+        return zstandard.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+def write_lexicon(path: str, lexical_entries: Iterable[LexicalEntry], format: str|None = None, compression: str|None = None) -> int:
+    """Writes the lexical entries one at a time, as an indented JSON array or as JSONL
+
+    Only one lexical entry is serialized at a time, so the memory does not grow with the lexicon.
+    The output is written to a temporary file renamed to path once complete, so an interrupted
+    export never leaves a truncated file. The JSON array is identical to json.dumps(..., indent=3).
+
+    Parameters:
+        path (str): path of the output
+        lexical_entries (Iterable[LexicalEntry]): lexical entries to be exported
+        format (str): json or jsonl, inferred from the extension of path if None
+        compression (str): gzip, zstd or None, inferred from the extension of path if format is None
+
+    Returns:
+        exported (int): number of exported lexical entries
+    """
+    if format is None:
+        format, compression = export_format(path)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    exported = 0
+    try:
+        with open_compressed(tmp_path, compression) as out_file:
+            for le in lexical_entries:
+                if format == "jsonl":
+                    out_file.write(json.dumps(le.to_dict(), ensure_ascii=False))
+                    out_file.write("\n")
+                else:
+                    out_file.write(",\n   " if exported else "[\n   ")
+                    out_file.write(json.dumps(le.to_dict(), ensure_ascii=False, indent=3).replace("\n", "\n   "))
+                exported += 1
+            if format != "jsonl":
+                out_file.write("\n]" if exported else "[]")
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError): #not created if the open failed
+            os.remove(tmp_path)
+        raise
+    return exported
@@ -1,10 +1,21 @@
 from complit_generation import *
 from datetime import datetime
-from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers.pydantic import PydanticOutputParser
 from langchain_core.exceptions import OutputParserException
+from langchain_core.rate_limiters import BaseRateLimiter
+from langchain_core.runnables import Runnable
 from tqdm import tqdm
 from utility import *
+from llm_cache import LLMCache
+from journal import Journal, journal_path
+from json_export import write_lexicon
+from lexicon_store import LexiconStore, is_lexicon_store, load_lexicon, save_lexicon
+from prompt_rendering import PROMPT_LAYOUTS, build_judge_prompt, judged_definitions, render_judge_prompt, structured_chain, system_prompt
+from run_stats import ModelStats
+from rate_limit import PROVIDER_LIMITS_PATH, configure_rate_limits, invoke_with_backoff, rate_limiters, transient_delay
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 import argparse
 import gc
 import pydantic_models
@@ -15,71 +26,56 @@ import time
 from random import random
 import signal
 
-def judge_sense(modelname: str, llm: BaseChatModel, lemma: str, sense:UsemEntry, error_file, exclude: str,  overwriteScores:bool=False) -> bool:
-    global senseCounter
-    parser = PydanticOutputParser(pydantic_object=pydantic_models.ScoreOnly)
-    system_role = "Sei un esperto lessicografo."
-    activity_desc = """
-Rispondi esclusivamente con JSON valido conforme allo schema fornito.
-Non aggiungere testo, spiegazioni o formattazione extra.
-Devi valutare la bontà delle definizioni (SENSE_DEFINITION) di una parola (WORD) assegnando un voto da 1 a 10, dove 1 è pessimo e 10 perfetto, ad ogni SENSE_DEFINITION.
-"""
-    info_desc = "Per ogni SENSE_DEFINITION ti saranno fornite le seguenti informazioni:"
-    info_desc += """
-- WORD: la parola cui appartiene il senso;\n"""
-    if exclude != "examples":
-        info_desc += "- EXAMPLE: è l'esempio di uso della parola con quel senso;\n" if sense.example else ""
-    info_desc += "- CONCEPT: è il concetto cui fa riferimento il senso della parola;\n" if sense.template else ""
-    
-    if exclude != "relations":
-        info_desc += "- RELATIONS: è un elenco di relazioni con altre parole;\n" if sense.relations else ""
-    sense_desc  = "WORD: {};\n".format(lemma)
-    if exclude != "examples":
-        sense_desc += "EXAMPLE: {};\n".format(sense.example) if sense.example else ""
-    sense_desc += "CONCEPT: {};\n".format(sense.template) if sense.template else ""
-    if exclude != "relations":
-        if sense.relations:
-            relations_list = []
-            for rel in sense.relations:
-                expl = "- {}".format(format_relation(lemma,rel))
-                if expl != "- ":
-                    relations_list.append(expl)
-            sense_desc+="RELATIONS: {};\n".format(";\n".join(relations_list))
-    #progress_ai = tqdm(desc="Ai definitions evaluation", total=len(sense.ai_definitions), leave=False)
- 
-    parser = PydanticOutputParser(pydantic_object=pydantic_models.Scores)
-
-    prompt_text = system_role + activity_desc + info_desc + sense_desc
-    definition_preable = "I SENSE_DEFINITION da valutare sono:\n"
-    definition = ""
-    for idx, ai_def in enumerate(sense.ai_definitions):
-        indice = next((i for i, d in enumerate(ai_def.scores) if d.model == modelname), None) #se esiste già una valutazione con quel modello
-        if indice is None or overwriteScores:
-            definition += "SENSE_DEFINITION {} - \"{}\";\n".format(idx + 1,ai_def.definition)
-        else:
-            print("Evaluation with model {} already present. Skip".format(ai_def.scores[indice]))
-            continue
-    if definition != "":
-        prompt_text += definition_preable + definition
-    else:
-        print("No sense to evaluate.\n")
-        return True
+def judge_chain(llm: BaseChatModel, layout: str = "inline") -> tuple[PydanticOutputParser, Runnable]:
+    """Returns the output parser and the chain prepending the Scores format instructions to the prompt,
+    or sending them with the static instructions as system message in the prefix layout"""
+    return structured_chain(llm, pydantic_models.Scores, system_prompt("judge") if layout == "prefix" else None)
+
+
+def log_judge_prompt(prompt_text: str):
     with open("judge_prompts.txt", "a") as jp:
         jp.write("**** JUDGE PROMPT {} ****\n".format(senseCounter))
         jp.write(prompt_text)
         jp.write("\n")
 
-    struct_prompt = PromptTemplate(
-                    template="{format_instructions}\n{query}",
-                    input_variables=["query"],
-                    partial_variables={"format_instructions":parser.get_format_instructions()}
-                )
-    
-    prompt_and_model = struct_prompt|llm
+
+def apply_judge_scores(modelname: str, sense: UsemEntry, parsed_out: pydantic_models.Scores, journal: Journal|LexiconStore|None=None):
+    """Stores the scores given by a judge to the AI definitions of a sense, overwriting its previous ones, and journals them"""
+    for idx, ai_def in enumerate(sense.ai_definitions):
+        #print("AI_DEF before judge: {}".format(json.dumps(ai_def.to_dict()), ensure_ascii=False))
+        #se esiste lo score fatto con quel modello lo sovrascrivo
+        indice = next((i for i, d in enumerate(ai_def.scores) if d.model == modelname), None)
+        if indice is None:
+            ai_def.scores.append(Score(model=modelname,
+                            score=parsed_out.scores[idx]))
+        else:   
+            print("Score already present: {}. Overwrite!".format(parsed_out.scores[idx]))
+            ai_def.scores[indice] = Score(model=modelname,
+                            score=parsed_out.scores[idx])
+        if journal is not None:
+            journal.record_score(sense.usem, ai_def.model, modelname, parsed_out.scores[idx])
+        #print("AI_DEF after judge: {}".format(json.dumps(ai_def.to_dict()), ensure_ascii=False))
+
+
+def judge_sense(modelname: str, llm: BaseChatModel, lemma: str, sense:UsemEntry, error_file, exclude: str,  overwriteScores:bool=False, journal: Journal|LexiconStore|None=None,
+                stats: ModelStats|None=None, layout: str="inline", deferred: list[tuple[str, UsemEntry]]|None=None) -> bool:
+    prompt_text = build_judge_prompt(modelname, lemma, sense, exclude, overwriteScores, layout)
+    if prompt_text is None:
+        return True
+    log_judge_prompt(prompt_text)
+
+    parser, prompt_and_model = judge_chain(llm, layout)
 
     try:
-        out_resp = prompt_and_model.invoke({"query":prompt_text})
+        llm_start = time.time()
+        out_resp = invoke_with_backoff(prompt_and_model, {"query":prompt_text}, getattr(llm, "rate_limiter", None), retries=2)
+        if stats is not None:
+            stats.record(time.time() - llm_start, out_resp)
     except Exception as e:
+        if deferred is not None and transient_delay(e) is not None: #still throttled: retried at the end of the run
+            print("Sense {} deferred: {}".format(sense.usem, type(e).__name__))
+            deferred.append((lemma, sense))
+            return True
         str = "Error invoking LLM {}".format(e)
         error_file.write(str)
         error_file.flush()
@@ -90,29 +86,21 @@ Devi valutare la bontà delle definizioni (SENSE_DEFINITION) di una parola (WORD
     try:
         parsed_out = parser.invoke(out_resp)
         #print("Parsed OUT: {}".format(parsed_out))
-    except OutputParserException:
-        print("Error parsing output") 
-        error_file.write(json.dumps(sense.to_dict()), ensure_ascii=False)
+    except OutputParserException as e: #the sense is skipped, as by judge_panel, and the run goes on
+        print("Error parsing output of sense {}, skipped".format(sense.usem))
+        if stats is not None:
+            stats.record_parse_failure(out_resp)
+        error_file.write("Error parsing {}: {}\n".format(json.dumps(sense.to_dict(), ensure_ascii=False), e))
         error_file.flush()
-        return False
-    for idx, ai_def in enumerate(sense.ai_definitions):
-        #print("AI_DEF before judge: {}".format(json.dumps(ai_def.to_dict()), ensure_ascii=False))
-        #se esiste lo score fatto con quel modello lo sovrascrivo
-        indice = next((i for i, d in enumerate(ai_def.scores) if d.model == modelname), None)
-        if indice is None:
-            ai_def.scores.append(Score(model=modelname,
-                            score=parsed_out.scores[idx]))
-        else:   
-            print("Score already present: {}. Overwrite!".format(parsed_out.scores[idx]))
-            ai_def.scores[indice] = Score(model=modelname,
-                            score=parsed_out.scores[idx])
-        #print("AI_DEF after judge: {}".format(json.dumps(ai_def.to_dict()), ensure_ascii=False))
+        return True
+    apply_judge_scores(modelname, sense, parsed_out, journal)
 
     #progress_ai.update()
     return True
 
 
-def judge_lexical_entry(modelname: str, llm: BaseChatModel, lexical_entry: LexicalEntry, error_file, exclude: str, overwriteScore: bool=False) -> bool:
+def judge_lexical_entry(modelname: str, llm: BaseChatModel, lexical_entry: LexicalEntry, error_file, exclude: str, overwriteScore: bool=False, journal: Journal|LexiconStore|None=None,
+                        stats: ModelStats|None=None, layout: str="inline", deferred: list[tuple[str, UsemEntry]]|None=None) -> bool:
     #progress_senses = tqdm(desc="Senses", total=len(lexical_entry.senses), leave=False)
     global senseCounter
     for sense in lexical_entry.senses:
@@ -123,12 +111,202 @@ def judge_lexical_entry(modelname: str, llm: BaseChatModel, lexical_entry: Lexic
                     sense=sense,
                     error_file=error_file,
                     exclude=exclude,
-                    overwriteScores=overwriteScore)
+                    overwriteScores=overwriteScore,
+                    journal=journal,
+                    stats=stats,
+                    layout=layout,
+                    deferred=deferred)
         #progress_senses.update()
         if not success:
             return False
     return True
 
+def judge_matrix(modelname: str, llm: BaseChatModel, lexicons: dict[str, list[LexicalEntry]], error_file, overwriteScore: bool=False,
+                 journals: dict[str, Journal]|None=None, stats: ModelStats|None=None, layout: str="inline") -> bool:
+    """Scores the AI definitions of many ablation modes, sending each distinct judge prompt only once
+
+    Parameters:
+        modelname (str): name of the judge model
+        llm (BaseChatModel): chat model
+        lexicons (dict[str, list[LexicalEntry]]): lexical entries of each ablation mode (see EXCLUDE_MODES)
+        error_file: file logging invocation and parsing errors
+        overwriteScore (bool): score again the definitions already scored by the judge
+        journals (dict[str, Journal]): journal of each ablation mode, no journal if None
+        stats (ModelStats): collects the duration, prefill time and prompt tokens of each request
+        layout (str): prompt layout, one of PROMPT_LAYOUTS
+
+    Returns:
+        success (bool): False if the judging stopped for an error
+    """
+    global senseCounter
+    requests: dict[str, list[tuple[str, UsemEntry]]] = {}
+    senses = 0
+    for mode, lexical_entries in lexicons.items():
+        for le in lexical_entries:
+            for sense in le.senses:
+                prompt_text = build_judge_prompt(modelname, le.lemma, sense, mode_exclude(mode), overwriteScore, layout) # type: ignore
+                if prompt_text is not None:
+                    requests.setdefault(prompt_text, []).append((mode, sense))
+                    senses += 1
+    print("Judge matrix: {} distinct prompts for {} senses in {} modes".format(len(requests), senses, len(lexicons)))
+
+    parser, prompt_and_model = judge_chain(llm, layout)
+    for prompt_text, targets in tqdm(requests.items(), desc="Prompts", total=len(requests)):
+        senseCounter += 1
+        log_judge_prompt(prompt_text)
+        try:
+            llm_start = time.time()
+            out_resp = invoke_with_backoff(prompt_and_model, {"query":prompt_text}, getattr(llm, "rate_limiter", None))
+            if stats is not None:
+                stats.record(time.time() - llm_start, out_resp)
+        except Exception as e:
+            error_file.write("Error invoking LLM {}".format(e))
+            error_file.flush()
+            return False
+        try:
+            parsed_out = parser.invoke(out_resp)
+        except OutputParserException as e: #the prompt is skipped and the run goes on
+            print("Error parsing output of sense {}, skipped".format(targets[0][1].usem))
+            if stats is not None:
+                stats.record_parse_failure(out_resp)
+            error_file.write("Error parsing {}: {}\n".format(json.dumps(targets[0][1].to_dict(), ensure_ascii=False), e))
+            error_file.flush()
+            continue
+        for mode, sense in targets:
+            apply_judge_scores(modelname, sense, parsed_out, journals[mode] if journals else None)
+    return True
+
+
+def parse_judge(spec: str) -> tuple[str|None, str]:
+    """Parses a --judge REMOTE:MODEL value, e.g. ChatGroq:llama-3.3-70b-versatile. ChatOllama:MODEL is a local model
+
+    Returns:
+        judge (tuple[str|None, str]): remote service (None for a local model) and model name
+    """
+    remote, sep, modelname = spec.partition(":")
+    if not sep or not remote or not modelname:
+        raise argparse.ArgumentTypeError("judge must be REMOTE:MODEL, e.g. ChatGroq:llama-3.3-70b-versatile or ChatOllama:gemma3:12b")
+    return (None if remote == "ChatOllama" else remote), modelname
+
+
+@dataclass
+class PanelJudge:
+    """A judge of the panel, invoked by its own worker thread"""
+    modelname: str
+    """judge model name"""
+    parser: PydanticOutputParser
+    """Scores parser"""
+    chain: Runnable
+    """chain invoking the judge model"""
+    stats: ModelStats
+    """duration, prefill time and prompt tokens of the requests"""
+    executor: ThreadPoolExecutor
+    """single worker thread: the requests of a judge are sequential, the judges run concurrently"""
+    limiter: BaseRateLimiter|None = None
+    """rate limiter of the judge model, delaying the requests of the judge after a 429"""
+    failures: int = 0
+    """senses not scored for an invocation or parsing error"""
+
+
+def invoke_judge(judge: PanelJudge, prompt_text: str) -> pydantic_models.Scores|Exception:
+    """Sends a judge prompt to a panel judge, in its worker thread
+
+    Returns:
+        parsed_out (Scores|Exception): parsed scores, or the invocation or parsing error
+    """
+    try:
+        llm_start = time.time()
+        out_resp = invoke_with_backoff(judge.chain, {"query":prompt_text}, judge.limiter)
+        judge.stats.record(time.time() - llm_start, out_resp)
+    except Exception as e:
+        return e
+    try:
+        return judge.parser.invoke(out_resp)
+    except OutputParserException as e:
+        judge.stats.record_parse_failure(out_resp)
+        return e
+
+
+def merge_panel_scores(sense: UsemEntry, results: list[tuple[str, tuple[int, ...], pydantic_models.Scores]], journal: Journal|LexiconStore|None=None):
+    """Stores the scores of all the judges of the panel into the AI definitions of a sense in one pass
+
+    Parameters:
+        sense (UsemEntry): judged sense
+        results (list[tuple[str, tuple[int, ...], Scores]]): judge name, indexes of the scored AI definitions
+            and parsed scores of each judge, in the order of the panel
+        journal (Journal|LexiconStore): journal of the run, or the store saving each score, no journal if None
+    """
+    by_index = [(modelname, dict(zip(indexes, parsed_out.scores))) for modelname, indexes, parsed_out in results]
+    for idx, ai_def in enumerate(sense.ai_definitions):
+        scores = {score.model: i for i, score in enumerate(ai_def.scores)}
+        for modelname, judge_scores in by_index:
+            if idx not in judge_scores:
+                continue
+            if modelname in scores:
+                ai_def.scores[scores[modelname]] = Score(model=modelname, score=judge_scores[idx])
+            else:
+                scores[modelname] = len(ai_def.scores)
+                ai_def.scores.append(Score(model=modelname, score=judge_scores[idx]))
+            if journal is not None:
+                journal.record_score(sense.usem, ai_def.model, modelname, judge_scores[idx])
+
+
+def judge_panel(judges: list[PanelJudge], lexical_entries: list[LexicalEntry], error_file, exclude: str, overwriteScore: bool=False,
+                journal: Journal|LexiconStore|None=None, layout: str="inline", window: int=64):
+    """Scores the AI definitions with a panel of judges running concurrently
+
+    The judge prompt of a sense is rendered once for all the judges with the same definitions to score,
+    and sent to the worker thread of each judge. The scores are merged in the senses by the calling thread,
+    in the order of the senses and of the panel, so the output does not depend on the timing of the judges.
+    A judge failing on a sense is logged in error_file and leaves the sense unscored by it, without
+    stopping the other judges.
+
+    Parameters:
+        judges (list[PanelJudge]): the panel
+        lexical_entries (list[LexicalEntry]): lexical entries whose AI definitions are scored
+        error_file: file logging invocation and parsing errors
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        overwriteScore (bool): score again the definitions already scored by a judge
+        journal (Journal|LexiconStore): journal of the run, or the store saving each score, no journal if None
+        layout (str): prompt layout, one of PROMPT_LAYOUTS
+        window (int): max number of senses sent to the judges and not yet merged
+    """
+    global senseCounter
+    pending: deque[tuple[UsemEntry, list[tuple[PanelJudge, tuple[int, ...], Future]]]] = deque()
+
+    def merge(sense: UsemEntry, requests: list[tuple[PanelJudge, tuple[int, ...], Future]]):
+        results = []
+        for judge, indexes, request in requests:
+            parsed_out = request.result()
+            if isinstance(parsed_out, Exception):
+                judge.failures += 1
+                error_file.write("Error judging {} with {}: {}\n".format(sense.usem, judge.modelname, parsed_out))
+                error_file.flush()
+                continue
+            results.append((judge.modelname, indexes, parsed_out))
+        merge_panel_scores(sense, results, journal)
+
+    for le in tqdm(lexical_entries, desc="Lexical entries"):
+        for sense in le.senses:
+            prompts: dict[tuple[int, ...], str] = {}
+            requests = []
+            for judge in judges:
+                indexes = judged_definitions(judge.modelname, sense, overwriteScore)
+                if not indexes:
+                    continue
+                if indexes not in prompts:
+                    senseCounter += 1
+                    prompts[indexes] = render_judge_prompt(le.lemma, sense, exclude, indexes, layout) # type: ignore
+                    log_judge_prompt(prompts[indexes])
+                requests.append((judge, indexes, judge.executor.submit(invoke_judge, judge, prompts[indexes])))
+            if requests:
+                pending.append((sense, requests))
+            while len(pending) > window:
+                merge(*pending.popleft())
+    while pending:
+        merge(*pending.popleft())
+
+
 #Controlla se tutti gli score di una definizione AI generated superano la soglia (6)
 def meanScore(ai_definitions:list[Score]) -> float:
     score = 0
@@ -239,18 +417,71 @@ def statistics(lexical_entries:list[LexicalEntry]) -> None:
     for k,v in modelsStat.items():
         print("Stats by model generator: {} mean score: {:.2f}".format(k,modelsStat[k]/totalScores[k] ))
 
+def judge_modes(args, outputFileName: str):
+    """Runs the statistics or the judging on the pickles of the ablation modes given with --matrix"""
+    lexicons: dict[str, list[LexicalEntry]] = {}
+    for mode in args.matrix:
+        lexicons[mode] = load_lexicon(mode_path(args.pickle, mode))
+
+    if args.stats:
+        for mode, lexical_entries in lexicons.items():
+            print("*** MODE: {} ***".format(mode))
+            selectBestDefinition(lexical_entries)
+            statistics(lexical_entries)
+            write_lexicon(mode_path(outputFileName, mode), lexical_entries)
+        return
+
+    journals: dict[str, Journal] = {}
+    for mode in args.matrix:
+        journals[mode] = Journal(journal_path(mode_path(args.pickle, mode)), compact_every=args.journal_compact_every,
+                                 on_compact=lambda mode=mode: save_lexicon(mode_path(args.pickle, mode), lexicons[mode]))
+        lexicons[mode] = list(journals[mode].replay(lexicons[mode]))
+    llm_cache = LLMCache(args.llm_cache, args.llm_cache_max_entries) if args.llm_cache else None
+    llm = config_model(remote=args.remote, modelname=args.modelname, temperature=0, cache=llm_cache, structured_output=bool(args.structured_output))
+    error_file = open('output/errors/judge_errors_{}.json'.format(datetime.now().strftime("%Y_%m_%d-%H_%M_%S")), 'w', encoding='utf-8')
+    stats = ModelStats(args.modelname)
+    try:
+        judge_matrix(args.modelname, llm, lexicons, error_file, args.overwrite, journals, stats, args.prompt_layout)
+    except KeyboardInterrupt:
+        print('KeyboardInterrupt')
+    finally:
+        error_file.close()
+        for mode, lexical_entries in lexicons.items():
+            save_lexicon(mode_path(args.pickle, mode), lexical_entries)
+            journals[mode].reset()
+            journals[mode].close()
+            write_lexicon(mode_path(outputFileName, mode), lexical_entries)
+        print(stats.report())
+        if llm_cache is not None:
+            print(llm_cache.report())
+            llm_cache.close()
+        print("END EVALUATION")
+
+
 def main():
     load_dotenv()
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--modelname', required=False, type=str, help="Name of the model used as a judge")
-    parser.add_argument('-p', '--pickle', required=True, type=str, help="Path to the pickle file from which load the data")
+    parser.add_argument('-p', '--pickle', required=True, type=str, help="Path to the pickle file from which load the data, or to a SQLite lexicon store if it ends with .sqlite or .db")
     parser.add_argument('-o', '--output', type=str, help="path/filename for the json computed output")
     parser.add_argument('-w', "--overwrite", type=bool, action=argparse.BooleanOptionalAction, help="Overwrite scores")
     parser.add_argument('-r', '--remote', type=str, help="If the model is remote")
     parser.add_argument('-s', '--stats', type=bool, action=argparse.BooleanOptionalAction, help="Generate statistics and evaluations")
     parser.add_argument('-x', '--exclude',  type=str, help="Exclude relation, examples or both in definition generation: [relations|examples|both]")
 
+    parser.add_argument("--matrix", type=str, nargs="+", choices=EXCLUDE_MODES, help="Ablation modes judged in a single pass, sharing identical prompts. Pickle and output of each mode get the mode as suffix")
+    parser.add_argument("--llm-cache", type=str, help="Path to the SQLite store of the LLM responses. Identical prompts are sent to the model only once")
+    parser.add_argument("--llm-cache-max-entries", type=int, help="Max number of responses in the LLM cache, least recently used are evicted")
+    parser.add_argument("--journal-compact-every", type=int, default=500, help="Number of scores after which the pickle is saved and its journal emptied")
+    parser.add_argument("--prompt-layout", type=str, default="inline", choices=PROMPT_LAYOUTS, help="inline: instructions and sense data in the same message; prefix: static instructions in a system message identical for all the requests (reused by the prompt caches), sense data last")
+    parser.add_argument("--judge", type=parse_judge, action="append", help="REMOTE:MODEL of a judge of the panel (ChatOllama:MODEL for a local model), repeatable. The judges of the panel run concurrently, each sense prompt is rendered once. Replaces -r and -m")
+    parser.add_argument("--structured-output", type=bool, action=argparse.BooleanOptionalAction, help="Constrained decoding of the responses: Ollama JSON schema format, JSON mode for the remote models")
+    parser.add_argument("--rate-limits", type=str, default=PROVIDER_LIMITS_PATH, help="Json config of the requests (rpm) and tokens (tpm) per minute of each REMOTE or REMOTE:MODEL")
+    parser.add_argument("--deferred-rounds", type=int, default=3, help="Number of times the senses throttled by the service are retried at the end of the run")
+    parser.add_argument("--relation-types", type=str, default=RELATION_TYPES_PATH, help="Json config mapping each relation type URI to its Italian description in the prompts (null to leave the type out)")
     args = parser.parse_args()
+    load_relation_types(args.relation_types)
+    configure_rate_limits(args.rate_limits)
 
     global senseCounter
     senseCounter = 0
@@ -259,8 +490,6 @@ def main():
         print("Exclude must have one of this string value 'relations' ,'examples' or 'both'")
         sys.exit(-1)
 
-    with open(args.pickle, 'rb') as pickle_input:
-        lexical_entries: list[LexicalEntry] = pickle.load(pickle_input)
     overwriteScore = args.overwrite
 
     if args.output:
@@ -268,53 +497,117 @@ def main():
     else:
         raise(FileNotFoundError("You have to specify json output file using -o|--output flag. Example -o output/generated_defs.json"))
 
+    if args.matrix:
+        judge_modes(args, outputFileName)
+        return
+
+    store = LexiconStore(args.pickle) if is_lexicon_store(args.pickle) else None
+    if store is not None:
+        #only the senses with definitions still to be scored by the judge are loaded
+        lexical_entries: list[LexicalEntry] = store.load(lacking_score=None if args.stats or overwriteScore else
+                                                         [modelname for _, modelname in args.judge] if args.judge else args.modelname)
+    else:
+        with open(args.pickle, 'rb') as pickle_input:
+            lexical_entries = pickle.load(pickle_input)
 
     if args.stats:
         selectBestDefinition(lexical_entries)
         #save_to_pickle(args.pickle, lexical_entries)
         statistics(lexical_entries)
+        if store is not None:
+            store.close()
 
-        with open(outputFileName,'w', encoding="utf-8") as out_json: #'output/lex_defs_judged.json'
-                encoded_out = json.dumps([le_def.to_dict() for le_def in lexical_entries],ensure_ascii=False, indent=3)
-                out_json.write(encoded_out)
+        write_lexicon(outputFileName, lexical_entries) #'output/lex_defs_judged.json'
     else: 
         #Scores generation   
            #judged_le: list[LexicalEntry] = []
 
-        llm = config_model(remote=args.remote, 
-                        modelname=args.modelname,
-                        temperature=0)
+        #scores of an interrupted run are replayed from the journal, so their senses are skipped
+        if store is None:
+            journal = Journal(journal_path(args.pickle), compact_every=args.journal_compact_every,
+                              on_compact=lambda: save_to_pickle(args.pickle, lexical_entries))
+            lexical_entries = list(journal.replay(lexical_entries))
+        llm_cache = LLMCache(args.llm_cache, args.llm_cache_max_entries) if args.llm_cache else None
+        judges: list[PanelJudge] = []
+        for remote, modelname in args.judge or []:
+            panel_llm = config_model(remote=remote, modelname=modelname, temperature=0, cache=llm_cache, structured_output=bool(args.structured_output))
+            panel_parser, panel_chain = judge_chain(panel_llm, args.prompt_layout)
+            judges.append(PanelJudge(modelname, panel_parser, panel_chain, ModelStats(modelname),
+                                     ThreadPoolExecutor(max_workers=1, thread_name_prefix="judge"), getattr(panel_llm, "rate_limiter", None)))
+        if not judges:
+            llm = config_model(remote=args.remote, 
+                            modelname=args.modelname,
+                            temperature=0,
+                            cache=llm_cache,
+                            structured_output=bool(args.structured_output))
                         
         progress_le = tqdm(desc="Lexical entries", total=len(lexical_entries), leave=True)
         error_file = open('output/errors/judge_errors_{}.json'.format(datetime.now().strftime("%Y_%m_%d-%H_%M_%S")), 'w', encoding='utf-8')
+        stats = ModelStats(args.modelname)
         try:
-
-            for le in lexical_entries:
-                if le is not None:
-                    #print("{}: {}".format(le,le.to_dict()))
-                    #success = judged_le.append(judge_lexical_entry(modelname=args.modelname,
-                    success = judge_lexical_entry(modelname=args.modelname,
-                                        llm=llm,
-                                        lexical_entry=le,
-                                        error_file=error_file,
-                                        exclude=args.exclude,
-                                        overwriteScore=overwriteScore)
-                    if not success: #problema nella valutazione => salvo quello che ho fatto
+            if judges:
+                progress_le.close()
+                judge_panel(judges, lexical_entries, error_file, args.exclude, overwriteScore,
+                            journal=store if store is not None else journal, layout=args.prompt_layout)
+            else:
+                deferred: list[tuple[str, UsemEntry]] = []
+                for le in lexical_entries:
+                    if le is not None:
+                        #print("{}: {}".format(le,le.to_dict()))
+                        #success = judged_le.append(judge_lexical_entry(modelname=args.modelname,
+                        success = judge_lexical_entry(modelname=args.modelname,
+                                            llm=llm,
+                                            lexical_entry=le,
+                                            error_file=error_file,
+                                            exclude=args.exclude,
+                                            overwriteScore=overwriteScore,
+                                            journal=store if store is not None else journal, #the store saves each score with a single row upsert
+                                            stats=stats,
+                                            layout=args.prompt_layout,
+                                            deferred=deferred)
+                        if not success: #problema nella valutazione => salvo quello che ho fatto
+                            break
+                        progress_le.update()
+                    else:
+                        print("Lexical Entry is NONE???")
+                for retry_round in range(args.deferred_rounds):
+                    if not deferred:
                         break
-                    progress_le.update()
-                else:
-                    print("Lexical Entry is NONE???")
+                    print("Retrying {} deferred senses (round {})".format(len(deferred), retry_round + 1))
+                    retrying, deferred = deferred, []
+                    for lemma, sense in retrying:
+                        if not judge_sense(args.modelname, llm, lemma, sense, error_file, args.exclude, overwriteScore,
+                                           store if store is not None else journal, stats, args.prompt_layout, deferred):
+                            break
+                if deferred:
+                    print("{} senses still throttled, not scored".format(len(deferred)))
         except KeyboardInterrupt:
             print('KeyboardInterrupt')
         finally:
+            for judge in judges:
+                judge.executor.shutdown(cancel_futures=True)
             error_file.close()
             filename, file_extension = os.path.splitext(args.pickle)
             scoresFileName = filename + "_scores" + file_extension
             #save_to_pickle(scoresFileName, lexical_entries)
-            save_to_pickle(args.pickle, lexical_entries)
-            with open(outputFileName,'w', encoding="utf-8") as out_json: #'output/lex_defs_judged.json'
-                encoded_out = json.dumps([le_def.to_dict() for le_def in lexical_entries],ensure_ascii=False, indent=3)
-                out_json.write(encoded_out)
+            if store is not None:
+                lexical_entries = store.load()
+                store.close()
+            else:
+                save_to_pickle(args.pickle, lexical_entries)
+                journal.reset()
+                journal.close()
+            write_lexicon(outputFileName, lexical_entries) #'output/lex_defs_judged.json'
+            if judges:
+                for judge in judges:
+                    print("{} failures: {}".format(judge.stats.report(), judge.failures))
+            else:
+                print(stats.report())
+            for limiter in rate_limiters.values():
+                print(limiter.report())
+            if llm_cache is not None:
+                print(llm_cache.report())
+                llm_cache.close()
             print("END EVALUATION")
 
 
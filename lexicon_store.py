@@ -0,0 +1,281 @@
+from complit_generation import *
+from typing import Iterable, Iterator
+import os
+import pickle
+import sqlite3
+import threading
+
+
+STORE_EXTENSIONS = (".sqlite", ".db")
+"""Extensions of the -p paths opened as a LexiconStore instead of a pickle"""
+
+
+def is_lexicon_store(path: str|None) -> bool:
+    """Returns True if path is a SQLite lexicon store, False if it is a pickle"""
+    return path is not None and os.path.splitext(path)[1] in STORE_EXTENSIONS
+
+
+class LexiconStore:
+    """SQLite store of the lexical entries, an alternative to the pickle
+
+    Senses, relations, AI definitions and scores are rows of their own tables, indexed on usem,
+    generator model and judge model. A new definition or score is a single row upsert committed
+    at once, so the store has the same record_definition/record_score interface of the Journal,
+    and the senses still to be defined or judged are selected by the database.
+    """
+
+    def __init__(self, path: str):
+        """Initialize the store
+
+        Parameters:
+            path (str): path to the SQLite database, created if missing
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                lemma_id TEXT PRIMARY KEY,
+                lemma TEXT NOT NULL,
+                position INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS senses (
+                usem TEXT PRIMARY KEY,
+                lemma_id TEXT NOT NULL REFERENCES entries (lemma_id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                definition TEXT,
+                template TEXT,
+                example TEXT,
+                chosen_definition TEXT,
+                chosen_score REAL,
+                chosen_model TEXT);
+            CREATE TABLE IF NOT EXISTS relations (
+                sense_usem TEXT NOT NULL REFERENCES senses (usem) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                usem TEXT,
+                lemma TEXT,
+                definition TEXT,
+                type TEXT,
+                example TEXT,
+                PRIMARY KEY (sense_usem, position));
+            CREATE TABLE IF NOT EXISTS ai_definitions (
+                usem TEXT NOT NULL REFERENCES senses (usem) ON DELETE CASCADE,
+                model TEXT NOT NULL,
+                definition TEXT,
+                mean_score REAL NOT NULL DEFAULT 0.0,
+                PRIMARY KEY (usem, model));
+            CREATE TABLE IF NOT EXISTS scores (
+                usem TEXT NOT NULL,
+                definition_model TEXT NOT NULL,
+                judge TEXT NOT NULL,
+                score INTEGER,
+                PRIMARY KEY (usem, definition_model, judge),
+                FOREIGN KEY (usem, definition_model) REFERENCES ai_definitions (usem, model) ON DELETE CASCADE);
+            CREATE INDEX IF NOT EXISTS senses_lemma_id ON senses (lemma_id, position);
+            CREATE INDEX IF NOT EXISTS entries_position ON entries (position);
+            CREATE INDEX IF NOT EXISTS ai_definitions_model ON ai_definitions (model, usem);
+            CREATE INDEX IF NOT EXISTS scores_judge ON scores (judge, usem, definition_model);
+        """)
+        self.connection.commit()
+
+
+    def __enter__(self) -> "LexiconStore":
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def add_entry(self, le: LexicalEntry):
+        """Inserts a lexical entry with its senses, replacing the stored one with the same lemma_id (not committed)"""
+        self.connection.execute("DELETE FROM entries WHERE lemma_id=?", (le.lemma_id,))
+        self.connection.execute("""INSERT INTO entries (lemma_id, lemma, position)
+                                   VALUES (?, ?, (SELECT COALESCE(MAX(position), -1) + 1 FROM entries))""", (le.lemma_id, le.lemma))
+        for sense_position, sense in enumerate(le.senses):
+            self.connection.execute("DELETE FROM senses WHERE usem=?", (sense.usem,)) #a sense moved to another entry
+            self.connection.execute("""INSERT INTO senses (usem, lemma_id, position, definition, template, example, chosen_definition, chosen_score, chosen_model)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                    (sense.usem, le.lemma_id, sense_position, sense.definition, sense.template, sense.example,
+                                     sense.chosenAiDef, sense.chosenAiDefScore, sense.chosenAiDefModelGenerator))
+            self.connection.executemany("""INSERT INTO relations (sense_usem, position, usem, lemma, definition, type, example)
+                                           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                        [(sense.usem, i, relation.usem, relation.lemma, relation.definition, relation.type, relation.example)
+                                         for i, relation in enumerate(sense.relations)])
+            for ai_def in sense.ai_definitions:
+                self.connection.execute("INSERT OR REPLACE INTO ai_definitions (usem, model, definition, mean_score) VALUES (?, ?, ?, ?)",
+                                        (sense.usem, ai_def.model, ai_def.definition, ai_def.mean_score))
+                self.connection.executemany("INSERT OR REPLACE INTO scores (usem, definition_model, judge, score) VALUES (?, ?, ?, ?)",
+                                            [(sense.usem, ai_def.model, score.model, score.score) for score in ai_def.scores])
+
+
+    def save(self, lexical_entries: Iterable[LexicalEntry]):
+        """Replaces the content of the store with the lexical entries, in a single transaction"""
+        with self.lock:
+            self.connection.execute("DELETE FROM entries")
+            for le in lexical_entries:
+                self.add_entry(le)
+            self.connection.commit()
+
+
+    def saving(self, lexical_entries: Iterable[LexicalEntry]) -> Iterator[LexicalEntry]:
+        """Stores each lexical entry as it is consumed, for the entries retrieved in --stream mode
+
+        Parameters:
+            lexical_entries (Iterable[LexicalEntry]): lexical entries being retrieved
+
+        Returns:
+            lexical_entries (Iterator[LexicalEntry]): the same lexical entries, once stored
+        """
+        for le in lexical_entries:
+            with self.lock:
+                self.add_entry(le)
+                self.connection.commit()
+            yield le
+
+
+    @staticmethod
+    def selection(lacking_definition: str|None = None, lacking_score: str|list[str]|None = None) -> tuple[str, tuple]:
+        """Returns the query selecting the usems of the senses to be loaded and its parameters (see load)"""
+        if lacking_definition is not None:
+            return "SELECT usem FROM senses WHERE usem NOT IN (SELECT usem FROM ai_definitions WHERE model=?)", (lacking_definition,)
+        if lacking_score is not None:
+            judges = (lacking_score,) if isinstance(lacking_score, str) else tuple(lacking_score)
+            return "SELECT DISTINCT a.usem FROM ai_definitions a WHERE " + " OR ".join(
+                ["NOT EXISTS (SELECT 1 FROM scores s WHERE s.judge=? AND s.usem=a.usem AND s.definition_model=a.model)"] * len(judges)), judges
+        return "SELECT usem FROM senses", ()
+
+
+    def load(self, lacking_definition: str|None = None, lacking_score: str|list[str]|None = None) -> list[LexicalEntry]:
+        """Loads the lexical entries, or only the senses still to be defined or judged by a model
+
+        Parameters:
+            lacking_definition (str): if given, only the senses without a definition generated by this model
+            lacking_score (str|list[str]): if given, only the senses with an AI definition not scored by this judge (by any of these judges)
+
+        Returns:
+            lexical_entries (list[LexicalEntry]): lexical entries in the stored order, without the ones with no selected sense
+        """
+        selection, params = self.selection(lacking_definition, lacking_score)
+        return self.load_selected(selection, params)
+
+
+    def iterate(self, lacking_definition: str|None = None, batch_size: int = 1000) -> Iterator[LexicalEntry]:
+        """Loads the lexical entries batch_size at a time, so the memory does not grow with the store
+
+        Parameters:
+            lacking_definition (str): if given, only the senses without a definition generated by this model
+            batch_size (int): number of lexical entries loaded by each query
+
+        Returns:
+            lexical_entries (Iterator[LexicalEntry]): lexical entries in the stored order, without the ones with no selected sense
+        """
+        selection, params = self.selection(lacking_definition)
+        last_position = -1
+        while True:
+            with self.lock:
+                positions = [row[0] for row in self.connection.execute("SELECT position FROM entries WHERE position > ? ORDER BY position LIMIT ?",
+                                                                       (last_position, batch_size))]
+            if not positions:
+                return
+            batch_selection = "{} INTERSECT SELECT s.usem FROM senses s JOIN entries e ON s.lemma_id=e.lemma_id WHERE e.position BETWEEN ? AND ?".format(selection)
+            yield from self.load_selected(batch_selection, (*params, positions[0], positions[-1]))
+            last_position = positions[-1]
+
+
+    def load_selected(self, selection: str, params: tuple) -> list[LexicalEntry]:
+        """Loads the senses whose usem is returned by the selection query, grouped in their lexical entries"""
+        with self.lock:
+            relations: dict[str, list[Relation]] = {}
+            for row in self.connection.execute("""WITH selected AS ({}) SELECT sense_usem, usem, lemma, definition, type, example FROM relations
+                                                  WHERE sense_usem IN selected ORDER BY sense_usem, position""".format(selection), params):
+                relations.setdefault(row[0], []).append(Relation(*row[1:]))
+            scores: dict[tuple[str, str], list[Score]] = {}
+            for row in self.connection.execute("""WITH selected AS ({}) SELECT usem, definition_model, judge, score FROM scores
+                                                  WHERE usem IN selected ORDER BY rowid""".format(selection), params):
+                scores.setdefault((row[0], row[1]), []).append(Score(model=row[2], score=row[3]))
+            ai_definitions: dict[str, list[AIDefinition]] = {}
+            for usem, model, definition, mean_score in self.connection.execute("""WITH selected AS ({}) SELECT usem, model, definition, mean_score FROM ai_definitions
+                                                                                 WHERE usem IN selected ORDER BY rowid""".format(selection), params):
+                ai_definitions.setdefault(usem, []).append(AIDefinition(model, definition, scores.get((usem, model), []), mean_score))
+            lexical_entries: list[LexicalEntry] = []
+            for lemma_id, lemma, usem, definition, template, example, chosen_definition, chosen_score, chosen_model in self.connection.execute(
+                    """WITH selected AS ({}) SELECT e.lemma_id, e.lemma, s.usem, s.definition, s.template, s.example, s.chosen_definition, s.chosen_score, s.chosen_model
+                       FROM senses s JOIN entries e ON s.lemma_id=e.lemma_id WHERE s.usem IN selected ORDER BY e.position, s.position""".format(selection), params):
+                if not lexical_entries or lexical_entries[-1].lemma_id != lemma_id:
+                    lexical_entries.append(LexicalEntry(lemma, lemma_id, []))
+                lexical_entries[-1].senses.append(UsemEntry(usem, definition, template, example, relations.get(usem, []),
+                                                            ai_definitions.get(usem, []), chosen_definition, chosen_score, chosen_model))
+        return lexical_entries
+
+
+    def record_definition(self, usem: str, model: str, definition: str):
+        """Stores the definition of a sense generated by a model, overwriting the previous one by the same model and its scores"""
+        with self.lock:
+            self.connection.execute("DELETE FROM scores WHERE usem=? AND definition_model=?", (usem, model))
+            self.connection.execute("""INSERT INTO ai_definitions (usem, model, definition, mean_score) VALUES (?, ?, ?, 0.0)
+                                       ON CONFLICT (usem, model) DO UPDATE SET definition=excluded.definition, mean_score=0.0""",
+                                    (usem, model, definition))
+            self.connection.commit()
+
+
+    def record_score(self, usem: str, definition_model: str, judge: str, score: int):
+        """Stores the score given by a judge to the definition of a sense generated by definition_model"""
+        with self.lock:
+            self.connection.execute("""INSERT INTO scores (usem, definition_model, judge, score) VALUES (?, ?, ?, ?)
+                                       ON CONFLICT (usem, definition_model, judge) DO UPDATE SET score=excluded.score""",
+                                    (usem, definition_model, judge, score))
+            self.connection.commit()
+
+
+    def remove_definitions(self, model: str) -> int:
+        """Removes all the definitions generated by a model, with their scores
+
+        Returns:
+            removed (int): number of removed definitions
+        """
+        with self.lock:
+            removed = self.connection.execute("DELETE FROM ai_definitions WHERE model=?", (model,)).rowcount
+            self.connection.commit()
+        return removed
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def load_lexicon(path: str) -> list[LexicalEntry]:
+    """Loads the lexical entries from a pickle or from a LexiconStore, according to the extension of path"""
+    if is_lexicon_store(path):
+        with LexiconStore(path) as store:
+            return store.load()
+    with open(path, 'rb') as data_file:
+        return pickle.load(data_file, encoding="utf-8")
+
+
+def save_pickle(path: str, obj):
+    """Pickles obj to path atomically: to a temporary file in the same directory, forced to disk and
+    renamed to path, so a crash while saving leaves the previous pickle intact"""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as out_file:
+            pickle.dump(obj, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_lexicon(path: str, lexical_entries: list[LexicalEntry]):
+    """Saves the lexical entries to a pickle or to a LexiconStore, according to the extension of path"""
+    if is_lexicon_store(path):
+        with LexiconStore(path) as store:
+            store.save(lexical_entries)
+    else:
+        save_pickle(path, lexical_entries)
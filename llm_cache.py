@@ -0,0 +1,151 @@
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, Generation
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """Persistent SQLite store of LLM responses, keyed on (provider, model, temperature, params, prompt hash)
+
+    The store is shared by all the models of a run: config_model attaches to each model the view
+    returned by for_model. When the store exceeds max_entries, the least recently used responses are evicted.
+    """
+
+    def __init__(self, path: str = "data/llm_cache.sqlite", max_entries: int|None = None):
+        """Initialize the store
+
+        Parameters:
+            path (str): path to the SQLite database, created if missing
+            max_entries (int): max number of responses kept, unbounded if None
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            temperature REAL NOT NULL,
+            params TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            response TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (provider, model, temperature, params, prompt_hash))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+    def for_model(self, provider: str, modelname: str, temperature: float, params: str = "") -> "ModelCache":
+        """Returns the cache to be attached to a model with the cache parameter
+
+        Parameters:
+            provider (str): remote service of the model, ChatOllama for local models
+            modelname (str): name of the model
+            temperature (float): temperature of the model
+            params (str): other parameters changing the responses of the model (e.g. the output length cap)
+
+        Returns:
+            cache (ModelCache): langchain cache bound to the model
+        """
+        return ModelCache(self, (provider, modelname, float(temperature), params))
+
+
+    def get(self, key: tuple, prompt_hash: str) -> str|None:
+        with self.lock:
+            row = self.connection.execute("""SELECT response FROM responses WHERE provider=? AND model=? AND temperature=? AND params=? AND prompt_hash=?""",
+                                          (*key, prompt_hash)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("""UPDATE responses SET last_used=? WHERE provider=? AND model=? AND temperature=? AND params=? AND prompt_hash=?""",
+                                    (time.time(), *key, prompt_hash))
+            self.connection.commit()
+            return row[0]
+
+
+    def put(self, key: tuple, prompt_hash: str, response: str):
+        with self.lock:
+            #INSERT OR REPLACE reports a rowcount of 1 also when it replaces a row: count only the new keys
+            exists = self.connection.execute("""SELECT 1 FROM responses WHERE provider=? AND model=? AND temperature=? AND params=? AND prompt_hash=?""",
+                                             (*key, prompt_hash)).fetchone() is not None
+            self.connection.execute("""INSERT OR REPLACE INTO responses (provider, model, temperature, params, prompt_hash, response, last_used)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?)""", (*key, prompt_hash, response, time.time()))
+            if not exists:
+                self.entries += 1
+            if self.max_entries is not None and self.entries > self.max_entries:
+                #recount before evicting, the database may be shared with other runs
+                self.entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+                if self.entries > self.max_entries:
+                    self.connection.execute("""DELETE FROM responses WHERE rowid IN
+                                               (SELECT rowid FROM responses ORDER BY last_used LIMIT ?)""", (self.entries - self.max_entries,))
+                    self.entries = self.max_entries
+            self.connection.commit()
+
+
+    def clear(self, key: tuple|None = None):
+        with self.lock:
+            if key is None:
+                self.connection.execute("DELETE FROM responses")
+            else:
+                self.connection.execute("DELETE FROM responses WHERE provider=? AND model=? AND temperature=? AND params=?", key)
+            self.connection.commit()
+            self.entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+    def report(self) -> str:
+        """Returns the hit/miss counters of the run"""
+        total = self.hits + self.misses
+        return "LLM cache: {} hits, {} misses ({:.1f}% hit rate), {} stored responses".format(
+            self.hits, self.misses, 100 * self.hits / total if total else 0, self.entries)
+
+
+    def close(self):
+        self.connection.close()
+
+
+class ModelCache(BaseCache):
+    """View of an LLMCache bound to a single model, the llm_string given by langchain is ignored"""
+
+    def __init__(self, store: LLMCache, key: tuple):
+        self.store = store
+        self.key = key
+
+
+    @staticmethod
+    def prompt_hash(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE|None:
+        response = self.store.get(self.key, self.prompt_hash(prompt))
+        if response is None:
+            return None
+        generations = []
+        for generation in json.loads(response):
+            if generation["message"] is not None:
+                generations.append(ChatGeneration(message=messages_from_dict([generation["message"]])[0],
+                                                  generation_info=generation["generation_info"]))
+            else:
+                generations.append(Generation(text=generation["text"], generation_info=generation["generation_info"]))
+        return generations
+
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        generations = [{"text": generation.text,
+                        "message": message_to_dict(generation.message) if isinstance(generation, ChatGeneration) else None,
+                        "generation_info": generation.generation_info}
+                       for generation in return_val]
+        self.store.put(self.key, self.prompt_hash(prompt), json.dumps(generations, ensure_ascii=False))
+
+
+    def clear(self, **kwargs) -> None:
+        self.store.clear(self.key)
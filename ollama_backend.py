@@ -0,0 +1,303 @@
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from langchain_ollama import ChatOllama
+from ollama import AsyncClient, Client
+from pydantic import PrivateAttr
+import asyncio
+import httpx
+import threading
+import time
+
+
+HEALTH_CHECK_TIMEOUT = 5.0
+"""Seconds within which a host must answer the health check"""
+
+
+def parse_keep_alive(value: str) -> str|int|float:
+    """Parses a --keep-alive value: a number of seconds (e.g. -1 forever, 0 unload at once) is passed to Ollama as a number,
+    since Ollama parses the strings as durations with a unit (e.g. 30m, 24h) and rejects "-1"
+
+    Returns:
+        keep_alive (str|int|float): seconds as int or float, otherwise the duration string
+    """
+    for number in (int, float):
+        try:
+            return number(value)
+        except ValueError:
+            pass
+    return value
+
+
+def warm_up_model(modelname: str, keep_alive: str|float = "30m", host: str|None = None) -> float:
+    """Loads a model in the Ollama server memory without generating, so that the first prompt does not pay the load
+
+    Parameters:
+        modelname (str): name of the Ollama model
+        keep_alive (str|float): how long the model stays loaded after the last request (e.g. "30m", -1 forever)
+        host (str): Ollama base url, OLLAMA_HOST or the local server if None
+
+    Returns:
+        load_time (float): seconds spent loading the model, 0 if it was already loaded
+    """
+    start = time.time()
+    response = Client(host=host).generate(model=modelname, prompt="", keep_alive=keep_alive)
+    if response.load_duration is not None:
+        return response.load_duration / 1e9
+    return time.time() - start
+
+
+def unload_model(modelname: str, host: str|None = None):
+    """Unloads a model from the Ollama server memory, freeing the VRAM for the next model
+
+    Parameters:
+        modelname (str): name of the Ollama model
+        host (str): Ollama base url, OLLAMA_HOST or the local server if None
+    """
+    Client(host=host).generate(model=modelname, prompt="", keep_alive=0)
+
+
+POOL_STRATEGIES = ["least-loaded", "round-robin"]
+"""least-loaded: each request goes to the healthy host with the fewest requests in flight;
+round-robin: the healthy hosts take the requests in turn"""
+
+
+@dataclass
+class OllamaHost:
+    """An Ollama server of the pool, with its health and its throughput during the run"""
+    url: str
+    """Ollama base url"""
+    client: Client
+    """client of the requests"""
+    async_client: AsyncClient
+    """client of the asynchronous requests"""
+    healthy: bool = True
+    """False after a failed health check or connection, until the next successful check"""
+    checked: float = 0.0
+    """time.monotonic() of the last health check"""
+    in_flight: int = 0
+    """requests in progress"""
+    requests: int = 0
+    """completed requests"""
+    failures: int = 0
+    """requests failed connecting to the host"""
+    output_tokens: int = 0
+    """tokens generated, the chunks received for the streams closed before the end"""
+    busy_time: float = 0.0
+    """seconds with at least a request in flight"""
+    busy_since: float = 0.0
+    """time.monotonic() when the requests in flight went from 0 to 1"""
+
+
+    def report(self, elapsed: float) -> str:
+        """Returns a line summarizing the throughput of the host over elapsed seconds of run"""
+        return "Ollama host {}: {} requests ({:.2f}/s) {} output tokens ({:.1f}/s while busy) busy: {:.0f}% failures: {}{}".format(
+            self.url, self.requests, self.requests / elapsed if elapsed else 0, self.output_tokens,
+            self.output_tokens / self.busy_time if self.busy_time else 0, 100 * self.busy_time / elapsed if elapsed else 0,
+            self.failures, "" if self.healthy else " (down)")
+
+
+class OllamaPool:
+    """Ollama servers sharing the requests of a run, each one with the model warmed up and pinned in memory
+
+    A host failing a health check or a connection is left out of the dispatch, and checked again after
+    recheck_interval seconds. A request failing to connect is sent to the next healthy host.
+    """
+
+    def __init__(self, urls: list[str], strategy: str = "least-loaded", recheck_interval: float = 30.0, timeout: float|None = None):
+        """Initialize the pool, checking the health of every host
+
+        Parameters:
+            urls (list[str]): Ollama base urls, e.g. http://gpu1:11434
+            strategy (str): dispatch of the requests, one of POOL_STRATEGIES
+            recheck_interval (float): seconds after which a host down is checked again
+            timeout (float): seconds after which a request to a host fails, no timeout if None
+        """
+        self.hosts = [OllamaHost(url, Client(host=url, timeout=timeout), AsyncClient(host=url, timeout=timeout)) for url in urls]
+        self.strategy = strategy
+        self.recheck_interval = recheck_interval
+        self.next_host = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        for host in self.hosts:
+            self.check(host)
+
+
+    def check(self, host: OllamaHost) -> bool:
+        """Checks that a host answers, marking it healthy or down
+
+        Returns:
+            healthy (bool): True if the host answered
+        """
+        try:
+            Client(host=host.url, timeout=HEALTH_CHECK_TIMEOUT).list()
+            host.healthy = True
+        except Exception as e:
+            if host.healthy:
+                print("WARN: Ollama host {} is down ({}: {})".format(host.url, type(e).__name__, e))
+            host.healthy = False
+        host.checked = time.monotonic()
+        return host.healthy
+
+
+    def acquire(self, exclude: tuple[OllamaHost, ...] = ()) -> OllamaHost:
+        """Chooses the host of a request by the strategy of the pool, and counts the request in flight
+
+        Parameters:
+            exclude (tuple[OllamaHost, ...]): hosts already failed by the request
+
+        Returns:
+            host (OllamaHost): host of the request
+        """
+        now = time.monotonic()
+        for host in self.hosts:
+            if not host.healthy and host not in exclude and now - host.checked > self.recheck_interval:
+                self.check(host)
+        with self.lock:
+            candidates = [host for host in self.hosts if host.healthy and host not in exclude]
+            if not candidates:
+                raise ConnectionError("No Ollama host available in {}".format([host.url for host in self.hosts]))
+            #hosts in turn from the one after the last chosen, so the ties of least-loaded are broken round-robin
+            candidates.sort(key=lambda host: (self.hosts.index(host) - self.next_host) % len(self.hosts))
+            host = min(candidates, key=lambda host: host.in_flight) if self.strategy == "least-loaded" else candidates[0]
+            self.next_host = self.hosts.index(host) + 1
+            if host.in_flight == 0:
+                host.busy_since = time.monotonic()
+            host.in_flight += 1
+            return host
+
+
+    def release(self, host: OllamaHost, output_tokens: int, failed: bool = False):
+        """Records the end of a request on a host, marking the host down if it failed connecting"""
+        with self.lock:
+            host.in_flight -= 1
+            if host.in_flight == 0:
+                host.busy_time += time.monotonic() - host.busy_since
+            if failed:
+                host.failures += 1
+                host.healthy = False
+                host.checked = time.monotonic()
+            else:
+                host.requests += 1
+                host.output_tokens += output_tokens
+
+
+    def warm_up(self, modelname: str, keep_alive: str|float = -1) -> float:
+        """Loads a model on all the healthy hosts at the same time, pinned for keep_alive
+
+        A host failing to load the model is marked down.
+
+        Returns:
+            load_time (float): seconds spent loading the model by the slowest host
+        """
+        def load(host: OllamaHost) -> float:
+            try:
+                return warm_up_model(modelname, keep_alive, host.url)
+            except Exception as e:
+                print("WARN: model {} not loaded on Ollama host {} ({}: {})".format(modelname, host.url, type(e).__name__, e))
+                host.healthy = False
+                host.checked = time.monotonic()
+                return 0.0
+        hosts = [host for host in self.hosts if host.healthy]
+        with ThreadPoolExecutor(max_workers=max(1, len(hosts))) as executor:
+            return max(executor.map(load, hosts), default=0.0)
+
+
+    def unload(self, modelname: str):
+        """Unloads a model from all the healthy hosts"""
+        for host in self.hosts:
+            if host.healthy:
+                try:
+                    unload_model(modelname, host.url)
+                except Exception as e:
+                    print("WARN: model {} not unloaded from Ollama host {} ({})".format(modelname, host.url, type(e).__name__))
+
+
+    def report(self) -> list[str]:
+        """Returns the throughput line of each host"""
+        elapsed = time.monotonic() - self.started
+        return [host.report(elapsed) for host in self.hosts]
+
+
+def part_tokens(part, tokens: int) -> int:
+    """Counts the output tokens of a streamed chat response: the chunks received, or eval_count in the last part"""
+    eval_count = part.get("eval_count") if isinstance(part, Mapping) else getattr(part, "eval_count", None) #ollama ChatResponse
+    return eval_count if eval_count is not None else tokens + 1
+
+
+class PooledChatOllama(ChatOllama):
+    """ChatOllama sending each request to a host of an OllamaPool
+
+    Everything else (format, num_predict, keep_alive, LLM cache, callbacks) is the one of ChatOllama.
+    """
+
+    _pool: OllamaPool|None = PrivateAttr(default=None)
+
+
+    def _create_chat_stream(self, messages, stop=None, **kwargs):
+        chat_params = self._chat_params(messages, stop, **kwargs)
+        failed: tuple[OllamaHost, ...] = ()
+        while True:
+            host = self._pool.acquire(failed) # type: ignore
+            tokens = 0
+            response = None
+            try:
+                response = host.client.chat(**chat_params)
+                for part in (response if chat_params["stream"] else [response]):
+                    tokens = part_tokens(part, tokens)
+                    yield part
+            except (ConnectionError, httpx.TransportError) as e:
+                self._pool.release(host, tokens, failed=True) # type: ignore
+                if tokens: #the response was already in progress
+                    raise
+                print("WARN: Ollama host {} failed ({}), request sent to another host".format(host.url, type(e).__name__))
+                failed += (host,)
+                continue
+            except BaseException: #also the stream closed by the early stop
+                self._pool.release(host, tokens) # type: ignore
+                raise
+            finally:
+                if chat_params["stream"] and response is not None:
+                    response.close()
+            self._pool.release(host, tokens) # type: ignore
+            return
+
+
+    async def _acreate_chat_stream(self, messages, stop=None, **kwargs):
+        chat_params = self._chat_params(messages, stop, **kwargs)
+        failed: tuple[OllamaHost, ...] = ()
+        while True:
+            host = await asyncio.to_thread(self._pool.acquire, failed) # type: ignore
+            tokens = 0
+            response = None
+            try:
+                response = await host.async_client.chat(**chat_params)
+                if chat_params["stream"]:
+                    async for part in response:
+                        tokens = part_tokens(part, tokens)
+                        yield part
+                else:
+                    tokens = part_tokens(response, tokens)
+                    yield response
+            except (ConnectionError, httpx.TransportError) as e:
+                self._pool.release(host, tokens, failed=True) # type: ignore
+                if tokens:
+                    raise
+                print("WARN: Ollama host {} failed ({}), request sent to another host".format(host.url, type(e).__name__))
+                failed += (host,)
+                continue
+            except BaseException:
+                self._pool.release(host, tokens) # type: ignore
+                raise
+            finally:
+                if chat_params["stream"] and response is not None:
+                    await response.aclose()
+            self._pool.release(host, tokens) # type: ignore
+            return
+
+
+def pooled_model(pool: OllamaPool, **kwargs) -> PooledChatOllama:
+    """Returns a ChatOllama (configured by kwargs) dispatching its requests to the hosts of pool"""
+    llm = PooledChatOllama(**kwargs)
+    llm._pool = pool
+    return llm
@@ -0,0 +1,417 @@
+from collections import OrderedDict
+from complit_generation import *
+from dataclasses import dataclass
+from functools import lru_cache
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.output_parsers.pydantic import PydanticOutputParser
+from langchain_core.outputs import Generation
+from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_ollama import ChatOllama
+from pydantic import BaseModel, ValidationError
+from utility import format_relation
+import json
+import sys
+import time
+
+
+PROMPT_LAYOUTS = ["inline", "prefix"]
+"""inline: instructions and sense data in a single user message (the original prompts);
+prefix: all the static instructions and the format instructions in a system message identical for every request,
+followed by the sense data, so that Ollama and the providers can reuse the cached prefix"""
+
+SYSTEM_ROLE = "Sei un esperto lessicografo."
+
+GENERATION_DESC = "Genera la definizione del senso della WORD data utilizzando le seguenti informazioni, dove:\n"
+
+LEMMA_GENERATION_DESC = "Genera la definizione di ciascun senso (USEM) della WORD data utilizzando le seguenti informazioni, dove:\n"
+
+DEFINITION_MAX_WORDS = 30
+"""Max words of a generated definition, asked by the prompts and used for the output token budget"""
+
+TOKENS_PER_WORD = 2.5
+"""Upper estimate of the tokens of an Italian word for the tokenizers of the models in use"""
+
+DEFINITION_JSON_TOKENS = 24
+"""Tokens of the JSON around a definition: keys, quotes, braces and the USEM of the lemma prompts"""
+
+GENERATION_LIMITS = f"""
+Rispondi esclusivamente con JSON valido conforme allo schema fornito.
+Non aggiungere testo, spiegazioni o formattazione extra.
+La definizione non deve superare le {DEFINITION_MAX_WORDS} parole.
+Non riscrivere WORD nella definizione.
+Integra queste informazioni con la tua conoscenza interna per generare la definizione.\n"""
+
+GENERATION_INFO = {
+    "examples": "- EXAMPLE: è l'esempio di uso della parola con quel senso\n",
+    "templates": "- CONCEPT: è il concetto cui fa riferimento il senso della parola\n",
+    "relations": "- RELATIONS: è un lista di relazioni con altre parole di cui è data la definizione\n",
+}
+"""Description line of each feature in the generation prompt, keyed on the -x|--exclude value of the feature"""
+
+JUDGE_ACTIVITY = """
+Rispondi esclusivamente con JSON valido conforme allo schema fornito.
+Non aggiungere testo, spiegazioni o formattazione extra.
+Devi valutare la bontà delle definizioni (SENSE_DEFINITION) di una parola (WORD) assegnando un voto da 1 a 10, dove 1 è pessimo e 10 perfetto, ad ogni SENSE_DEFINITION.
+"""
+
+JUDGE_INFO = {
+    "examples": "- EXAMPLE: è l'esempio di uso della parola con quel senso;\n",
+    "templates": "- CONCEPT: è il concetto cui fa riferimento il senso della parola;\n",
+    "relations": "- RELATIONS: è un elenco di relazioni con altre parole;\n",
+}
+"""Description line of each feature in the judge prompt, keyed on the -x|--exclude value of the feature"""
+
+
+@dataclass
+class SenseContext:
+    """Per-sense information rendered once and shared by the generation and judge prompts of any exclude mode"""
+    generation: dict[str, str]
+    """sense information of the generation prompt, keyed on the features the sense has"""
+    judge: dict[str, str]
+    """sense information of the judge prompt, keyed on the features the sense has"""
+
+
+SENSE_CONTEXTS_MAX = 65536
+"""Max number of rendered contexts kept, the least recently used are evicted"""
+
+sense_contexts: OrderedDict[tuple, SenseContext] = OrderedDict()
+"""LRU cache of the rendered contexts, keyed on context_key. Bounded, so it does not grow with the
+lexical entries of the --stream and --json runs"""
+
+
+def context_key(lemma: str, sense: UsemEntry) -> tuple:
+    """Returns the key of the context of a sense: the same usem may be retrieved with different examples, templates or relations"""
+    return (lemma, sense.usem, sense.example, sense.template,
+            tuple((rel.type, rel.usem, rel.lemma, rel.definition) for rel in sense.relations) if sense.relations else ())
+
+
+def sense_context(lemma: str, sense: UsemEntry) -> SenseContext:
+    """Returns the rendered information of a sense, rendering it on the first request
+
+    Parameters:
+        lemma (str): lemma of the lexical entry the sense belongs to
+        sense (UsemEntry): sense to be defined or judged
+
+    Returns:
+        context (SenseContext): EXAMPLE, CONCEPT and RELATIONS of the sense, when available
+    """
+    key = context_key(lemma, sense)
+    context = sense_contexts.get(key)
+    if context is not None:
+        sense_contexts.move_to_end(key)
+        return context
+    generation: dict[str, str] = {}
+    judge: dict[str, str] = {}
+    if sense.example:
+        generation["examples"] = "EXAMPLE: {}\n".format(sense.example)
+        judge["examples"] = "EXAMPLE: {};\n".format(sense.example)
+    if sense.template:
+        generation["templates"] = "CONCEPT: {}\n".format(sense.template)
+        judge["templates"] = "CONCEPT: {};\n".format(sense.template)
+    if sense.relations:
+        converted = [format_relation(lemma, rel) for rel in sense.relations]
+        relations_list = ["- {}".format(relation) for relation in converted if relation is not None]
+        if len(relations_list) > 0:
+            generation["relations"] = "RELATIONS: {}\n".format(";\n".join(relations_list))
+        else:
+            print("No useful relation for {}".format(sense.usem))
+            generation["relations"] = ""
+        judge["relations"] = "RELATIONS: {};\n".format(";\n".join("- {}".format(relation) for relation in converted if relation != "")) #the judge lists also "- None"
+    context = sense_contexts[key] = SenseContext(generation, judge)
+    if len(sense_contexts) > SENSE_CONTEXTS_MAX:
+        sense_contexts.popitem(last=False)
+    return context
+
+
+def clear_sense_contexts():
+    """Empties the cache of the rendered contexts, e.g. after the senses are retrieved again"""
+    sense_contexts.clear()
+
+
+@lru_cache(maxsize=None)
+def generation_header(exclude: str|None, features: tuple[str, ...]) -> str:
+    """Compiles the static part of a generation prompt, once for each exclude mode and set of features of the sense"""
+    information_desc = "".join(GENERATION_INFO[feature] for feature in features if feature != exclude)
+    return SYSTEM_ROLE + "\n" + GENERATION_DESC + information_desc + GENERATION_LIMITS
+
+
+def build_generation_prompt(lemma: str, sense: UsemEntry, exclude: str|None, layout: str = "inline") -> str:
+    """Builds the generation prompt for a sense
+
+    Parameters:
+        lemma (str): lemma of the lexical entry the sense belongs to
+        sense (UsemEntry): sense to be defined
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        layout (str): one of PROMPT_LAYOUTS
+
+    Returns:
+        prompt_text (str): prompt, without the format instructions. Only the sense data in the prefix layout
+    """
+    context = sense_context(lemma, sense).generation
+    word_incipit = "La WORD è \"{}\":\n".format(lemma)
+    sense_desc = "".join(desc for feature, desc in context.items() if feature != exclude)
+    if layout == "prefix":
+        return word_incipit + sense_desc
+    return generation_header(exclude, tuple(context)) + word_incipit + sense_desc
+
+
+@lru_cache(maxsize=None)
+def lemma_limits() -> str:
+    """Compiles the output limits of a lemma prompt"""
+    limits = GENERATION_LIMITS.replace("La definizione non deve", "Ogni definizione non deve")
+    return limits + "Restituisci una definizione per ogni USEM, riportando l'USEM esattamente come fornito.\n"
+
+
+def build_lemma_prompt(lemma: str, senses: list[UsemEntry], exclude: str|None, layout: str = "inline") -> str:
+    """Builds a single generation prompt for many senses of the same lemma
+
+    The instructions and the WORD are written once, followed by a block for each sense introduced by its USEM.
+
+    Parameters:
+        lemma (str): lemma of the lexical entry the senses belong to
+        senses (list[UsemEntry]): senses to be defined
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        layout (str): one of PROMPT_LAYOUTS
+
+    Returns:
+        prompt_text (str): prompt, without the format instructions. Only the senses data in the prefix layout
+    """
+    word_incipit = "La WORD è \"{}\" e i suoi sensi sono:\n".format(lemma)
+    information_desc = []
+    senses_desc = ""
+    for sense in senses:
+        context = sense_context(lemma, sense).generation
+        information_desc += [GENERATION_INFO[feature] for feature in context
+                             if feature != exclude and GENERATION_INFO[feature] not in information_desc]
+        senses_desc += "USEM: {}\n{}".format(sense.usem, "".join(desc for feature, desc in context.items() if feature != exclude))
+    if layout == "prefix":
+        return word_incipit + senses_desc
+    return SYSTEM_ROLE + "\n" + LEMMA_GENERATION_DESC + "".join(information_desc) + lemma_limits() + word_incipit + senses_desc
+
+
+@lru_cache(maxsize=None)
+def judge_header(exclude: str|None, features: tuple[str, ...]) -> str:
+    """Compiles the static part of a judge prompt, once for each exclude mode and set of features of the sense"""
+    info_desc = "Per ogni SENSE_DEFINITION ti saranno fornite le seguenti informazioni:"
+    info_desc += """
+- WORD: la parola cui appartiene il senso;\n"""
+    info_desc += "".join(JUDGE_INFO[feature] for feature in features if feature == "templates" or feature != exclude)
+    return SYSTEM_ROLE + JUDGE_ACTIVITY + info_desc
+
+
+def build_judge_prompt(modelname: str, lemma: str, sense: UsemEntry, exclude: str|None, overwriteScores: bool=False,
+                       layout: str = "inline") -> str|None:
+    """Builds the prompt asking to score the AI definitions of a sense
+
+    The CONCEPT is always given to the judge, also when the templates are excluded from the generation.
+
+    Parameters:
+        modelname (str): name of the judge model
+        lemma (str): lemma of the lexical entry the sense belongs to
+        sense (UsemEntry): sense whose AI definitions are scored
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        overwriteScores (bool): score again the definitions already scored by the judge
+        layout (str): one of PROMPT_LAYOUTS
+
+    Returns:
+        prompt_text (str|None): prompt, without the format instructions. Only the sense data and the definitions
+            in the prefix layout. None if there is no definition to score
+    """
+    return render_judge_prompt(lemma, sense, exclude, judged_definitions(modelname, sense, overwriteScores), layout)
+
+
+def judged_definitions(modelname: str, sense: UsemEntry, overwriteScores: bool=False) -> tuple[int, ...]:
+    """Returns the indexes of the AI definitions of a sense to be scored by a judge
+
+    Parameters:
+        modelname (str): name of the judge model
+        sense (UsemEntry): sense whose AI definitions are scored
+        overwriteScores (bool): score again the definitions already scored by the judge
+
+    Returns:
+        indexes (tuple[int, ...]): indexes in sense.ai_definitions, in order
+    """
+    indexes = []
+    for idx, ai_def in enumerate(sense.ai_definitions):
+        indice = next((i for i, d in enumerate(ai_def.scores) if d.model == modelname), None) #se esiste già una valutazione con quel modello
+        if indice is None or overwriteScores:
+            indexes.append(idx)
+        else:
+            print("Evaluation with model {} already present. Skip".format(ai_def.scores[indice]))
+    return tuple(indexes)
+
+
+def render_judge_prompt(lemma: str, sense: UsemEntry, exclude: str|None, indexes: tuple[int, ...], layout: str = "inline") -> str|None:
+    """Builds the prompt asking to score the AI definitions of a sense with the given indexes,
+    shared by all the judges having the same definitions to score
+
+    Parameters:
+        lemma (str): lemma of the lexical entry the sense belongs to
+        sense (UsemEntry): sense whose AI definitions are scored
+        exclude (str): feature excluded from the prompt: relations, examples, templates or None
+        indexes (tuple[int, ...]): indexes of the AI definitions to be scored, see judged_definitions
+        layout (str): one of PROMPT_LAYOUTS
+
+    Returns:
+        prompt_text (str|None): prompt, without the format instructions. None if there is no definition to score
+    """
+    if not indexes:
+        print("No sense to evaluate.\n")
+        return None
+    definition = "".join("SENSE_DEFINITION {} - \"{}\";\n".format(idx + 1, sense.ai_definitions[idx].definition) for idx in indexes)
+    context = sense_context(lemma, sense).judge
+    sense_desc = "WORD: {};\n".format(lemma)
+    sense_desc += "".join(desc for feature, desc in context.items() if feature == "templates" or feature != exclude)
+    if layout == "prefix":
+        return sense_desc + "I SENSE_DEFINITION da valutare sono:\n" + definition
+    return judge_header(exclude, tuple(context)) + sense_desc + "I SENSE_DEFINITION da valutare sono:\n" + definition
+
+
+@lru_cache(maxsize=None)
+def system_prompt(task: str) -> str:
+    """Compiles the system message of the prefix layout: the instructions describe every feature,
+    so the message is the same for all the senses and all the exclude modes
+
+    Parameters:
+        task (str): generation, lemma (generation of all the senses of a lemma) or judge
+
+    Returns:
+        system_prompt (str): static instructions, without the format instructions
+    """
+    if task == "generation":
+        return generation_header(None, tuple(GENERATION_INFO))
+    if task == "lemma":
+        return SYSTEM_ROLE + "\n" + LEMMA_GENERATION_DESC + "".join(GENERATION_INFO.values()) + lemma_limits()
+    return judge_header(None, tuple(JUDGE_INFO))
+
+
+def extract_json(text: str) -> dict|None:
+    """Returns the JSON object of a reply: the whole reply, or else the first object in it
+    (e.g. in a ```json block or after a preamble). None if the reply has no JSON object"""
+    text = text.strip()
+    try:
+        data = json.loads(text)
+        return data if isinstance(data, dict) else None
+    except ValueError:
+        pass
+    decoder = json.JSONDecoder()
+    start = text.find("{")
+    while start != -1:
+        try:
+            data, _ = decoder.raw_decode(text, start)
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+        start = text.find("{", start + 1)
+    return None
+
+
+class TolerantOutputParser(PydanticOutputParser):
+    """PydanticOutputParser validating first the JSON object found by extract_json, for the models
+    without constrained decoding. Replies it cannot validate go through the PydanticOutputParser,
+    which raises the OutputParserException"""
+
+    def parse_result(self, result: list[Generation], *, partial: bool = False):
+        data = extract_json(result[0].text)
+        if data is not None:
+            try:
+                return self.pydantic_object.model_validate(data)
+            except ValidationError:
+                pass
+        return super().parse_result(result, partial=partial)
+
+
+@lru_cache(maxsize=None)
+def output_parser(schema: type[BaseModel]) -> PydanticOutputParser:
+    """Returns the parser of a pydantic schema, built once"""
+    return TolerantOutputParser(pydantic_object=schema)
+
+
+@lru_cache(maxsize=None)
+def format_instructions(schema: type[BaseModel]) -> str:
+    """Returns the format instructions of a pydantic schema, rendered once"""
+    return output_parser(schema).get_format_instructions()
+
+
+def constrained_model(llm: BaseChatModel, schema: type[BaseModel]) -> Runnable:
+    """Binds the JSON schema of schema to an Ollama model configured for structured output (see config_model),
+    so its decoding is constrained by the schema. The remote models configured for structured output
+    are already in JSON mode, the other models are returned as they are"""
+    if isinstance(llm, ChatOllama) and llm.format is not None:
+        return llm.bind(format=schema.model_json_schema())
+    return llm
+
+
+def definition_token_budget(words: int = DEFINITION_MAX_WORDS) -> int:
+    """Returns the output tokens needed by the JSON reply of a definition of at most words words,
+    with a margin for the whitespace of the JSON"""
+    return int(words * TOKENS_PER_WORD) + DEFINITION_JSON_TOKENS + 16
+
+
+def scale_output_limit(llm: BaseChatModel, senses: int) -> BaseChatModel:
+    """Returns a copy of a chat model whose output limit (num_predict or max_tokens, see config_model)
+    is multiplied by senses, for the prompts defining many senses. The model itself if it has no limit"""
+    field = "num_predict" if isinstance(llm, ChatOllama) else "max_tokens"
+    max_tokens = getattr(llm, field, None)
+    if not max_tokens or senses <= 1:
+        return llm
+    return llm.model_copy(update={field: max_tokens * senses})
+
+
+def structured_chain(llm: BaseChatModel, schema: type[BaseModel], system: str|None = None) -> tuple[PydanticOutputParser, Runnable]:
+    """Returns the output parser and the chain prepending the format instructions of schema to the prompt
+
+    The chain is invoked with {"query": prompt_text}, as the PromptTemplate "{format_instructions}\\n{query}"
+    it replaces, without formatting a template at each request.
+
+    Parameters:
+        llm (BaseChatModel): chat model, constrained to the schema if configured for structured output
+        schema (type[BaseModel]): pydantic schema of the response
+        system (str): static instructions of the prefix layout, sent with the format instructions as a system message.
+            If None, the format instructions are prepended to the user message
+
+    Returns:
+        parser (PydanticOutputParser): parser of the response
+        chain (Runnable): chain invoking the model
+    """
+    prefix = format_instructions(schema) + "\n"
+    llm = constrained_model(llm, schema)
+    if system is not None:
+        system_message = SystemMessage(content=prefix + system)
+        return output_parser(schema), RunnableLambda(lambda inputs: [system_message, HumanMessage(content=inputs["query"])]) | llm
+    return output_parser(schema), RunnableLambda(lambda inputs: prefix + inputs["query"]) | llm
+
+
+def benchmark(lexical_entries: list[LexicalEntry], rounds: int = 3):
+    """Prints the generation and judge prompts rendered per second, with an empty and with a warm context cache"""
+    senses = [(le.lemma, sense) for le in lexical_entries for sense in le.senses]
+    for label, render in [("generation", lambda lemma, sense: build_generation_prompt(lemma, sense, None)),
+                          ("generation -x relations", lambda lemma, sense: build_generation_prompt(lemma, sense, "relations")),
+                          ("judge", lambda lemma, sense: build_judge_prompt("", lemma, sense, None))]:
+        for cache in ["cold", "warm"]:
+            best = None
+            for _ in range(rounds):
+                if cache == "cold":
+                    clear_sense_contexts()
+                start = time.perf_counter()
+                for lemma, sense in senses:
+                    render(lemma, sense)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("{} ({} cache): {:.0f} prompts/s".format(label, cache, len(senses) / best))
+
+
+if __name__ == "__main__":
+    from contextlib import redirect_stdout
+    import sparql #generate_defs and sparql import each other, sparql has to be imported first
+    from generate_defs import iter_json_complit
+    import io
+    input_path = sys.argv[1] if len(sys.argv) > 1 else "output/definitions-allfeats.json"
+    lexical_entries = list(iter_json_complit(input_path))
+    print("Rendering the prompts of {} senses".format(sum(len(le.senses) for le in lexical_entries)))
+    results = io.StringIO()
+    with redirect_stdout(results):
+        benchmark(lexical_entries)
+    print("\n".join(line for line in results.getvalue().splitlines() if "prompts/s" in line))
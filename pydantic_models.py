@@ -22,4 +22,10 @@ class ScoreOnly(BaseModel):
     score: int = Field(description="La valutazione data alla definizione come punteggio da 1 a 10")
 
 class Scores(BaseModel):
-    scores: list[int] = Field(description="La valutazione data alla definizione come punteggio da 1 a 10")
\ No newline at end of file
+    scores: list[int] = Field(description="La valutazione data alla definizione come punteggio da 1 a 10")
+
+class UsemDefOnly(DefOnly):
+    usem: str = Field(description="Identificativo USEM del senso definito")
+
+class LemmaDefs(BaseModel):
+    definitions: list[UsemDefOnly] = Field(description="Lista delle definizioni, una per ogni USEM della parola")
@@ -0,0 +1,298 @@
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.rate_limiters import BaseRateLimiter
+from sparql_client import RETRY_STATUS
+from email.utils import parsedate_to_datetime
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+
+
+PROVIDER_LIMITS_PATH = "data/provider_limits.json"
+"""Default config of the rate limits: requests (rpm) and tokens (tpm) per minute of each remote service,
+with optional "REMOTE:MODEL" entries for the models with their own limits"""
+
+TRANSIENT_ERRORS = ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "ConnectionError", "Timeout")
+"""Names of the client exceptions without HTTP status that are retried"""
+
+
+class TokenBucket:
+    """Bucket of capacity units refilled at capacity units per minute"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount units are available, amount is capped to the capacity"""
+        missing = min(amount, self.capacity) - self.available
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class ProviderRateLimiter(BaseRateLimiter):
+    """Rate limiter of a remote service: a request bucket (rpm), a token bucket (tpm) and the backoff after a 429
+
+    It is attached to the chat models with the rate_limiter parameter, so it is acquired only by the
+    requests not served by the LLM cache. The tokens of a request are not known in advance: each request
+    takes the mean tokens of the previous ones, and the difference is settled by record_tokens when
+    the usage of the response is known (see UsageCallback).
+    """
+
+    def __init__(self, name: str, rpm: float|None = None, tpm: float|None = None, tokens_per_request: float = 1000):
+        """Initialize the limiter
+
+        Parameters:
+            name (str): remote service (or REMOTE:MODEL) limited
+            rpm (float): requests per minute, unlimited if None
+            tpm (float): tokens per minute, unlimited if None
+            tokens_per_request (float): tokens estimated for the first request
+        """
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.tokens_per_request = tokens_per_request
+        self.blocked_until = 0.0
+        self.unsettled = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+
+    def try_acquire(self) -> float:
+        """Takes a request and its estimated tokens if available
+
+        Returns:
+            wait (float): 0 if acquired, else the seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            for bucket, amount in ((self.requests, 1), (self.tokens, self.tokens_per_request)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            if self.requests is not None:
+                self.requests.available -= 1
+            if self.tokens is not None:
+                self.tokens.available -= self.tokens_per_request
+            self.unsettled += 1
+            return 0.0
+
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        while (wait := self.try_acquire()) > 0:
+            if not blocking:
+                return False
+            time.sleep(wait)
+        return True
+
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        while (wait := self.try_acquire()) > 0:
+            if not blocking:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+
+    def record_tokens(self, tokens: int):
+        """Settles the tokens of a response against the estimate taken by acquire, and updates the estimate"""
+        with self.lock:
+            if self.unsettled == 0: #response served by the LLM cache
+                return
+            self.unsettled -= 1
+            if self.tokens is not None:
+                self.tokens.available -= tokens - self.tokens_per_request
+            self.tokens_per_request = 0.8 * self.tokens_per_request + 0.2 * tokens
+
+
+    def settle(self):
+        """Settles a response without usage (e.g. stopped early) at the estimate taken by acquire"""
+        with self.lock:
+            if self.unsettled > 0:
+                self.unsettled -= 1
+
+
+    def back_off(self, delay: float):
+        """Stops the requests for delay seconds, after the service throttled a request"""
+        with self.lock:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            if self.unsettled > 0: #the failed request has no usage to settle
+                self.unsettled -= 1
+
+
+    def report(self) -> str:
+        return "Rate limiter {}: {} throttled requests, {:.0f} tokens per request".format(self.name, self.throttled, self.tokens_per_request)
+
+
+class UsageCallback(BaseCallbackHandler):
+    """Passes the token usage of each response to the rate limiter of its model"""
+
+    def __init__(self, limiter: ProviderRateLimiter):
+        self.limiter = limiter
+
+
+    def on_llm_end(self, response: LLMResult, **kwargs):
+        if any(getattr(getattr(generation, "message", None), "response_metadata", {}).get("done_reason") == "early_stop"
+               for generations in response.generations for generation in generations):
+            self.limiter.settle() #the stream was closed before the usage, which would under-count the tokens
+            return
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        tokens = usage.get("total_tokens")
+        if tokens is None:
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    tokens = (tokens or 0) + (metadata.get("total_tokens") or 0)
+        if tokens:
+            self.limiter.record_tokens(tokens)
+
+
+def parse_duration(value: str) -> float|None:
+    """Parses a rate limit header value in seconds: "7.66s", "2m59.56s", "1h2m", "500ms", "12" or an HTTP date"""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.fullmatch(r"(?:(\d+(?:\.\d+)?)h)?(?:(\d+(?:\.\d+)?)m(?!s))?(?:(\d+(?:\.\d+)?)s)?(?:(\d+(?:\.\d+)?)ms)?", value)
+    if parts and any(parts.groups()):
+        hours, minutes, seconds, millis = (float(part) if part else 0.0 for part in parts.groups())
+        return hours * 3600 + minutes * 60 + seconds + millis / 1000
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def transient_delay(error: BaseException, attempt: int = 0, backoff: float = 2.0) -> float|None:
+    """Returns the seconds to wait before retrying a request failed for a transient error (429, 5xx, connection)
+
+    The delay is the Retry-After header of the response if present, else the x-ratelimit-reset-* header of the
+    exhausted bucket (x-ratelimit-remaining-* is 0): on Groq the requests bucket is the daily quota, so its reset
+    must not delay a request throttled by the tokens per minute. Without headers it grows exponentially with the attempt.
+
+    Parameters:
+        error (BaseException): exception raised by the chat model
+        attempt (int): number of the previous retries of the request
+        backoff (float): seconds to wait before the first retry without headers
+
+    Returns:
+        delay (float|None): seconds to wait, None if the error is not transient
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status not in RETRY_STATUS and type(error).__name__ not in TRANSIENT_ERRORS:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    retry_after = parse_duration(headers["retry-after"]) if headers.get("retry-after") else None
+    if retry_after is not None:
+        return retry_after
+    header_delays = [parse_duration(headers["x-ratelimit-reset-" + bucket]) for bucket in ("requests", "tokens")
+                     if headers.get("x-ratelimit-reset-" + bucket) and str(headers.get("x-ratelimit-remaining-" + bucket)).strip() == "0"]
+    header_delays = [header_delay for header_delay in header_delays if header_delay is not None]
+    if header_delays:
+        return max(header_delays)
+    return backoff * (2 ** attempt) * (1 + random.random() / 2)
+
+
+rate_limiters: dict[str, ProviderRateLimiter] = {}
+"""limiter of each remote service (or REMOTE:MODEL), shared by all the models using it"""
+
+provider_limits: dict[str, dict]|None = None
+"""rpm and tpm of each remote service (or REMOTE:MODEL), loaded from PROVIDER_LIMITS_PATH at the first use"""
+
+
+def configure_rate_limits(path: str = PROVIDER_LIMITS_PATH):
+    """Loads the rate limits config, a json object mapping each REMOTE or REMOTE:MODEL to {"rpm": ..., "tpm": ...}
+
+    Parameters:
+        path (str): path to the json config. If missing, the remote services are not limited
+    """
+    global provider_limits
+    provider_limits = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as config_file:
+            provider_limits = json.load(config_file)
+    else:
+        print("WARN: {} not found, remote models are not rate limited".format(path))
+    rate_limiters.clear()
+
+
+def provider_rate_limiter(remote: str, modelname: str) -> ProviderRateLimiter|None:
+    """Returns the limiter of a remote model: its REMOTE:MODEL limits if configured, else the limits of the remote service
+
+    Returns:
+        limiter (ProviderRateLimiter|None): shared limiter, None if neither has limits
+    """
+    if provider_limits is None:
+        configure_rate_limits()
+    for name in ("{}:{}".format(remote, modelname), remote):
+        if name in provider_limits: # type: ignore
+            if name not in rate_limiters:
+                limits = provider_limits[name] # type: ignore
+                rate_limiters[name] = ProviderRateLimiter(name, limits.get("rpm"), limits.get("tpm"))
+            return rate_limiters[name]
+    return None
+
+
+def invoke_with_backoff(chain, inputs: dict, limiter: BaseRateLimiter|None = None, retries: int = 5):
+    """Invokes a chain, retrying the requests throttled by the service or failed for a transient error
+
+    The delay is given to the limiter of the model, so all the requests to the same service wait for it.
+
+    Parameters:
+        chain (Runnable): chain invoking the model
+        inputs (dict): inputs of the chain
+        limiter (BaseRateLimiter): rate limiter of the model (llm.rate_limiter), if None the delay is slept here
+        retries (int): max number of retries
+
+    Returns:
+        out_resp: response of the chain
+    """
+    attempt = 0
+    while True:
+        try:
+            return chain.invoke(inputs)
+        except Exception as e:
+            delay = transient_delay(e, attempt)
+            if delay is None or attempt >= retries:
+                raise
+            print("Request throttled or failed ({}), retry in {:.1f}s".format(type(e).__name__, delay))
+            if isinstance(limiter, ProviderRateLimiter):
+                limiter.back_off(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+
+async def ainvoke_with_backoff(chain, inputs: dict, limiter: BaseRateLimiter|None = None, retries: int = 5):
+    """Asynchronous invoke_with_backoff"""
+    attempt = 0
+    while True:
+        try:
+            return await chain.ainvoke(inputs)
+        except Exception as e:
+            delay = transient_delay(e, attempt)
+            if delay is None or attempt >= retries:
+                raise
+            print("Request throttled or failed ({}), retry in {:.1f}s".format(type(e).__name__, delay))
+            if isinstance(limiter, ProviderRateLimiter):
+                limiter.back_off(delay)
+            else:
+                await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+import math
+
+
+@dataclass
+class ModelStats:
+    """Timing of a model during a run"""
+    model: str
+    """model name"""
+    load_time: float = 0.0
+    """seconds spent loading the model before the first request (cold load)"""
+    inference_times: list[float] = field(default_factory=list)
+    """seconds spent on each request"""
+    prefill_times: list[float] = field(default_factory=list)
+    """seconds spent by the server evaluating the prompt of each request, when reported"""
+    prompt_tokens: int = 0
+    """prompt tokens of the requests, for Ollama only the ones evaluated (not reused from the KV cache)"""
+    cached_tokens: int = 0
+    """prompt tokens read from the provider prompt cache, when reported"""
+    parse_failures: int = 0
+    """responses discarded because they do not match the output schema"""
+    wasted_tokens: int = 0
+    """prompt and output tokens of the discarded responses, when reported"""
+    output_tokens: int = 0
+    """tokens generated by the model, when reported"""
+    senses: int = 0
+    """senses of the requests, more than one for each lemma prompt"""
+    early_stops: int = 0
+    """responses stopped at the end of their JSON object (see early_stop.EarlyStopMixin)"""
+
+
+    def record(self, elapsed: float, response=None, senses: int = 1):
+        """Records the duration of a request for senses senses and, if the response is given, its prefill time and token counts"""
+        self.inference_times.append(elapsed)
+        self.senses += senses
+        if response is not None:
+            self.record_usage(response)
+
+
+    def record_usage(self, response):
+        """Records prefill time and prompt token counts from the metadata of a chat model response
+
+        Ollama reports prompt_eval_duration (ns) and prompt_eval_count, Groq token_usage.prompt_time (s),
+        providers with prompt caching input_token_details.cache_read in the usage metadata.
+        The replies stopped early have no usage metadata, only the estimate of their output tokens.
+        """
+        metadata = getattr(response, "response_metadata", None) or {}
+        usage = getattr(response, "usage_metadata", None) or {}
+        if metadata.get("prompt_eval_duration") is not None:
+            self.prefill_times.append(metadata["prompt_eval_duration"] / 1e9)
+        elif (metadata.get("token_usage") or {}).get("prompt_time") is not None:
+            self.prefill_times.append(metadata["token_usage"]["prompt_time"])
+        self.prompt_tokens += usage.get("input_tokens") or 0
+        self.output_tokens += usage.get("output_tokens") or metadata.get("output_tokens_estimate") or 0
+        if metadata.get("done_reason") == "early_stop":
+            self.early_stops += 1
+        self.cached_tokens += (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+
+    def record_parse_failure(self, response=None):
+        """Records a response discarded by the output parser, and its tokens"""
+        self.parse_failures += 1
+        usage = getattr(response, "usage_metadata", None) or {}
+        self.wasted_tokens += usage.get("total_tokens") or 0
+
+
+    @property
+    def inference_time(self) -> float:
+        return sum(self.inference_times)
+
+
+    def percentile(self, percent: float) -> float:
+        """Returns the duration of the requests at the given percentile (nearest rank)"""
+        if not self.inference_times:
+            return 0.0
+        times = sorted(self.inference_times)
+        return times[min(len(times) - 1, max(0, math.ceil(percent / 100 * len(times)) - 1))]
+
+
+    def report(self) -> str:
+        """Returns a line summarizing the timing of the model"""
+        requests = len(self.inference_times)
+        report = "Model: {} cold load: {:.2f}s inference: {:.2f}s requests: {} mean: {:.2f}s".format(
+            self.model, self.load_time, self.inference_time, requests, self.inference_time / requests if requests else 0)
+        if requests:
+            report += " p95: {:.2f}s p99: {:.2f}s max: {:.2f}s".format(self.percentile(95), self.percentile(99), max(self.inference_times))
+        if self.prefill_times:
+            report += " prefill: {:.2f}s mean: {:.3f}s".format(sum(self.prefill_times), sum(self.prefill_times) / len(self.prefill_times))
+        if self.prompt_tokens:
+            report += " prompt tokens: {} cached: {} ({:.1f}%)".format(self.prompt_tokens, self.cached_tokens,
+                                                                     100 * self.cached_tokens / self.prompt_tokens)
+        if self.output_tokens:
+            report += " output tokens: {} per sense: {:.1f}".format(self.output_tokens, self.output_tokens / self.senses if self.senses else 0)
+        if self.early_stops:
+            report += " early stops: {}".format(self.early_stops)
+        if self.parse_failures:
+            report += " parse failures: {} ({:.1f}%) wasted tokens: {}".format(self.parse_failures, 100 * self.parse_failures / requests if requests else 0,
+                                                                              self.wasted_tokens)
+        return report
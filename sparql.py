@@ -1,27 +1,210 @@
-from SPARQLWrapper import SPARQLWrapper, JSON, QueryResult
 from complit_generation import *
 from collections import OrderedDict
+from dataclasses import dataclass
 from generate_defs import parse_usems
+from sparql_client import SparqlClient
 from utility import save_to_pickle
 import os
-from dotenv import load_dotenv
+import re
+from typing import Iterable, Iterator
+import hashlib
+import json
 
-def sparql_query_execute(query_sparql: str) -> "QueryResult.ConvertResult":
+sparql_client: SparqlClient|None = None
+"""client shared by all the queries, created by configure_sparql_client or at the first query"""
 
-    load_dotenv()
 
-    sparql = SPARQLWrapper(
-        endpoint = os.getenv("SPARQL_REPO") # type: ignore
-    )
+def configure_sparql_client(**kwargs) -> SparqlClient:
+    """Replaces the shared SPARQL client with a new one
+
+    Parameters:
+        kwargs: SparqlClient parameters (endpoint, max_workers, max_per_endpoint, retries, backoff, timeout)
+
+    Returns:
+        client (SparqlClient): the new shared client
+    """
+    global sparql_client
+    if sparql_client is not None:
+        sparql_client.close()
+    sparql_client = SparqlClient(**kwargs)
+    return sparql_client
+
+
+def get_sparql_client() -> SparqlClient:
+    """Returns the shared SPARQL client, creating it with default parameters if needed"""
+    global sparql_client
+    if sparql_client is None:
+        sparql_client = SparqlClient()
+    return sparql_client
+
+
+RELATION_FILTERS_PATH = "data/relation_filters.json"
+"""Default config of the relations excluded from the retrieval"""
+
+
+@dataclass
+class RelationFilters:
+    """Relations excluded from the prompts: pushed into the queries as FILTER clauses, so the endpoint
+    does not return them, and applied again by prune_lexical_entry to the relations already retrieved"""
+    excluded_types: frozenset[str] = frozenset()
+    """relation type URIs"""
+    excluded_targets: frozenset[str] = frozenset()
+    """target usem URIs (e.g. entità, superclass of everything)"""
+
+
+    def keeps(self, relation: Relation) -> bool:
+        """Returns True if the relation is not excluded"""
+        return relation.type not in self.excluded_types and relation.usem not in self.excluded_targets
+
+
+    def clause(self) -> str:
+        """Returns the FILTER clauses on ?relation and ?target replacing the #FILTERS# placeholder of the queries"""
+        clauses = []
+        if self.excluded_types:
+            clauses.append("FILTER (?relation NOT IN ({}))".format(", ".join("<{}>".format(uri) for uri in sorted(self.excluded_types))))
+        if self.excluded_targets:
+            clauses.append("FILTER (?target NOT IN ({}))".format(", ".join("<{}>".format(uri) for uri in sorted(self.excluded_targets))))
+        return "\n    ".join(clauses)
+
+
+relation_filters: RelationFilters|None = None
+"""filters of all the queries, loaded by configure_relation_filters or at the first query"""
+
+
+def configure_relation_filters(path: str = RELATION_FILTERS_PATH) -> RelationFilters:
+    """Loads the relation filters from a json config with the "excluded_types" and "excluded_targets" URI lists
+
+    Parameters:
+        path (str): path to the json config
+
+    Returns:
+        filters (RelationFilters): the filters used by the following queries
+    """
+    global relation_filters
+    with open(path, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+    relation_filters = RelationFilters(frozenset(config.get("excluded_types", [])), frozenset(config.get("excluded_targets", [])))
+    return relation_filters
+
+
+def get_relation_filters() -> RelationFilters:
+    """Returns the relation filters, loading the default config if needed (no filter if it is missing)"""
+    global relation_filters
+    if relation_filters is None:
+        if os.path.exists(RELATION_FILTERS_PATH):
+            configure_relation_filters(RELATION_FILTERS_PATH)
+        else:
+            print("WARN: {} not found, relations are not filtered".format(RELATION_FILTERS_PATH))
+            relation_filters = RelationFilters()
+    return relation_filters # type: ignore
+
+
+def read_query(input_path: str) -> str:
+    """Reads a SPARQL query file, replacing the #FILTERS# placeholder with the FILTER clauses of the relation filters
+
+    Parameters:
+        input_path (str): path to the query SPARQL file
+
+    Returns:
+        query (str): text of the query
+    """
+    with open(input_path, 'r') as input_file:
+        query = input_file.read()
+    return query.replace("#FILTERS#", get_relation_filters().clause())
+
+
+def sparql_query_execute(query_sparql: str) -> dict:
+    """Executes a query on the SPARQL_REPO endpoint with the shared client
+
+    Parameters:
+        query_sparql (str): SPARQL query
+
+    Returns:
+        ret (dict): json result of the query
+    """
+    return get_sparql_client().execute(query_sparql)
+
+
+def sparql_query_execute_many(queries: list[str]) -> list[dict]:
+    """Executes many queries concurrently on the SPARQL_REPO endpoint with the shared client
+
+    Parameters:
+        queries (list[str]): SPARQL queries
+
+    Returns:
+        results (list[dict]): json results, in the same order of the queries
+    """
+    return get_sparql_client().execute_many(queries)
+
+
+CONCEPT_LABELS_QUERY = "data/sparql_queries/concept_labels.rq"
+"""Query of the labels of all the Simple_Ontology concepts"""
+
+concept_labels: dict[str, str]|None = None
+"""label (template) of each concept IRI, retrieved once at the first lookup"""
+
+
+def get_concept_labels(input_path: str = CONCEPT_LABELS_QUERY) -> dict[str, str]:
+    """Returns the label of each Simple_Ontology concept, retrieving the whole map with a single query at the first call
+
+    The senses queries return only the concept IRI: joining the labels here replaces the federated
+    SERVICE lookup repeated by the endpoint for every result row. With --sparql-cache the map is
+    also stored on disk by the shared client.
+
+    Parameters:
+        input_path (str): path to the concept labels query
+
+    Returns:
+        concept_labels (dict[str, str]): label of each concept IRI, the first in order if a concept has many labels
+    """
+    global concept_labels
+    if concept_labels is None:
+        labels: dict[str, str] = {}
+        for row in sparql_query_execute(read_query(input_path))["results"]["bindings"]: # type: ignore
+            labels.setdefault(row['concept']['value'], row['template']['value'])
+        concept_labels = labels
+    return concept_labels
+
+
+def sense_template(item: dict) -> str|None:
+    """Returns the template of a level 1 row: the ?template label if the query still returns it, else the label of ?concept"""
+    if 'template' in item:
+        return item['template'].get('value')
+    concept = item.get('concept', {}).get('value')
+    return get_concept_labels().get(concept) if concept is not None else None
+
+
+def group_senses(json_senses) -> list[LexicalEntry]:
+    """Groups the result rows of the level 1 query by lexical entry
 
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(query=query_sparql)
+    Parameters:
+        json_senses: json bindings of the level 1 query
 
-    try:
-        ret = sparql.queryAndConvert()
-    except Exception as e:
-        print("Exception: ",e)
-    return ret
+    Returns:
+        lexical_entries (list[LexicalEntry]): list of LexicalEntry partially initialized
+    """
+    lexical_entries: list[LexicalEntry] = []
+    grouped = OrderedDict()
+    for item in json_senses:
+        lid = item['le']['value'] # type: ignore #MUS
+        if lid not in grouped:
+            grouped[lid] = {
+                'lemma_id': lid,
+                'lemma': item.get('lemma',{}).get('value'),
+                'senses': []
+            }
+        grouped[lid]['senses'].append({
+            'usem': item.get('sense',{}).get("value"),
+            'definition': item.get("definition",{}).get("value"),
+            'relations': [],
+            'template': sense_template(item),
+            'example': item.get('example',{}).get('value'),
+            'ai_definitions': []
+            })
+    for entry in grouped.values():
+        lexical_extry = LexicalEntry(entry['lemma'], entry['lemma_id'], parse_usems(entry['senses']))
+        lexical_entries.append(lexical_extry)
+    return lexical_entries
 
 
 def first_level_query(input_path) -> list[LexicalEntry]:
@@ -33,37 +216,13 @@ def first_level_query(input_path) -> list[LexicalEntry]:
     Returns:
         lexical_entries (list[LexicalEntry]): list of LexicalEntry partially initialized
     """
-    with open(input_path, 'r') as input_file:
-        query = input_file.read()
+    query = read_query(input_path)
     ret = sparql_query_execute(query)
 
     json_senses = ret["results"]["bindings"] # type: ignore
     lexical_entries: list[LexicalEntry] = []
     if len(json_senses) > 0:
-        #print("json_senses: {}".format(json_senses))
-        grouped = OrderedDict()
-        for item in json_senses:
-            lid = item['le']['value'] # type: ignore #MUS
-            if lid not in grouped:
-                grouped[lid] = {
-                    'lemma_id': lid,
-                    'lemma': item.get('lemma',{}).get('value'),
-                    'senses': []
-                }
-            grouped[lid]['senses'].append({
-                'usem': item.get('sense',{}).get("value"),
-                'definition': item.get("definition",{}).get("value"),
-                'relations': [],
-                'template': item.get('template',{}).get('value'),
-                'example': item.get('example',{}).get('value'),
-                'ai_definitions': []
-                })
-            grouped_data = list(grouped.values())
-            #
-            # print(grouped[lid])
-        for entry in grouped_data:
-            lexical_extry = LexicalEntry(entry['lemma'], entry['lemma_id'], parse_usems(entry['senses']))
-            lexical_entries.append(lexical_extry)
+        lexical_entries = group_senses(json_senses)
     else:
         print("WARN: No Lexical Entries found! for the query: \"{}\"".format(query[:100]))
     #print([le.to_dict() for le in lexical_entries])
@@ -71,6 +230,79 @@ def first_level_query(input_path) -> list[LexicalEntry]:
     return lexical_entries
 
 
+def paged_query(query: str, page_size: int, offset: int) -> str:
+    """Returns a page of the level 1 query
+
+    The ORDER BY clause of the query is replaced with a total order on (?lemma, ?le, ?sense),
+    so that pages are stable and the rows of a lexical entry are consecutive.
+
+    Parameters:
+        query (str): level 1 query
+        page_size (int): number of rows of the page
+        offset (int): number of rows preceding the page
+
+    Returns:
+        query (str): query returning the page
+    """
+    query = re.sub(r"ORDER\s+BY.*$", "", query, flags=re.IGNORECASE|re.DOTALL).rstrip()
+    return "{}\nORDER BY ?lemma ?le ?sense\nLIMIT {}\nOFFSET {}".format(query, page_size, offset)
+
+
+def iter_first_level_query(input_path: str, page_size: int = 1000) -> Iterator[LexicalEntry]:
+    """Retrieves the level 1 query page by page, yielding each LexicalEntry as soon as all its senses are retrieved
+
+    The next page is requested while the current one is being consumed.
+
+    Parameters:
+        input_path (str): path to the query SPARQL file
+        page_size (int): number of rows of each page
+
+    Returns:
+        lexical_entries (Iterator[LexicalEntry]): LexicalEntry partially initialized
+    """
+    query = read_query(input_path)
+    client = get_sparql_client()
+    offset = 0
+    pending_rows = [] #rows of the last lexical entry of a page, which can continue in the next page
+    next_page = client.submit(paged_query(query, page_size, offset))
+    while True:
+        json_senses = next_page.result()["results"]["bindings"]
+        offset += page_size
+        last_page = len(json_senses) < page_size
+        if not last_page:
+            next_page = client.submit(paged_query(query, page_size, offset))
+        rows = pending_rows + json_senses
+        if last_page:
+            pending_rows = []
+        else:
+            last_lid = rows[-1]['le']['value']
+            split = len(rows)
+            while split > 0 and rows[split - 1]['le']['value'] == last_lid:
+                split -= 1
+            rows, pending_rows = rows[:split], rows[split:]
+        yield from group_senses(rows)
+        if last_page:
+            break
+
+
+def binding_to_relation(relation) -> Relation:
+    """Transforms a SPARQL result row of the relations query into a Relation
+
+    Parameters:
+        relation: json binding of a single result row
+
+    Returns:
+        relation (Relation): object representing the semantic relation
+    """
+    return Relation(
+        usem=relation.get('target', {}).get('value'),
+        lemma=relation.get('lemma', {}).get('value'),
+        definition=relation.get('def', {}).get('value'),
+        type=relation.get('relation', {}).get('value'),
+        example=relation.get('example', {}).get('value')
+    )
+
+
 def second_level_query(input_path:str, sense_id:str) -> list[Relation]:
 # def second_level_query(test) -> list[Relation]:
     """Retrieves and returns all relations for a sense
@@ -82,19 +314,97 @@ def second_level_query(input_path:str, sense_id:str) -> list[Relation]:
     Returns:
         relations (list[Relation]): list of relations for a sense
     """
-    with open(input_path,'r') as input_file:
-        query = input_file.read().replace("#USEM#", sense_id)
+    query = read_query(input_path).replace("#USEM#", sense_id)
     ret = sparql_query_execute(query)
     json_relations = ret["results"]["bindings"] # type: ignore
     # json_relations = test["results"]["bindings"]
     relations: list[Relation] = []
     for relation in json_relations:
-        relations.append(Relation(
-            usem=relation.get('target', {}).get('value'),
-            lemma=relation.get('lemma', {}).get('value'),
-            definition=relation.get('def', {}).get('value'),
-            type=relation.get('relation', {}).get('value'),
-            example=relation.get('example', {}).get('value')
-        ))
+        relations.append(binding_to_relation(relation))
     return relations
-    
\ No newline at end of file
+
+
+def batch_relations_query(template: str, sense_ids: list[str]) -> str:
+    """Rewrites the single sense relations query into a query for many senses
+
+    The subject "<#USEM#>" of the template becomes the variable ?sense, which is
+    projected and bound by a VALUES block listing all the requested senses.
+
+    Parameters:
+        template (str): text of the level 2 query containing the "<#USEM#>" placeholder
+        sense_ids (list[str]): senses unique identifiers
+
+    Returns:
+        query (str): SPARQL query retrieving the relations of all the senses
+    """
+    values = "VALUES ?sense {{ {} }}".format(" ".join("<{}>".format(sense_id) for sense_id in sense_ids))
+    query = template.replace("<#USEM#>", "?sense")
+    query = re.sub(r"SELECT\s+(DISTINCT\s+)?", lambda m: m.group(0) + "?sense ", query, count=1, flags=re.IGNORECASE)
+    query = re.sub(r"WHERE\s*\{", lambda m: m.group(0) + "\n        " + values, query, count=1, flags=re.IGNORECASE)
+    return query
+
+
+def second_level_query_batch(input_path:str, sense_ids:list[str], batch_size:int=50) -> dict[str, list[Relation]]:
+    """Retrieves the relations of many senses, batch_size senses for each SPARQL request
+
+    The requests are executed concurrently by the shared SPARQL client.
+
+    Parameters:
+        input_path (str): path to the query SPARQL file, the same used by second_level_query
+        sense_ids (list[str]): senses unique identifiers
+        batch_size (int): max number of senses for each SPARQL request
+
+    Returns:
+        relations (dict[str, list[Relation]]): relations grouped by sense identifier
+    """
+    template = read_query(input_path)
+    relations: dict[str, list[Relation]] = {sense_id: [] for sense_id in sense_ids}
+    unique_ids = list(relations.keys())
+    queries = [batch_relations_query(template, unique_ids[start:start + batch_size])
+               for start in range(0, len(unique_ids), batch_size)]
+    for ret in sparql_query_execute_many(queries):
+        for relation in ret["results"]["bindings"]: # type: ignore
+            relations[relation['sense']['value']].append(binding_to_relation(relation))
+    return relations
+
+
+RELATION_TARGETS_QUERY = "data/sparql_queries/relation_targets.rq"
+"""Query of the type and target of the relations of a sense, without the target details, used by the delta sync.
+It must select the same relations as the level 2 query (relations.rq), target FILTER included, or the stored senses never match"""
+
+
+def sense_fingerprint(example: str|None, template: str|None, relations: Iterable[tuple[str, str]]) -> str:
+    """Returns the hash of the sense data compared by the delta sync
+
+    Parameters:
+        example (str): example of the sense
+        template (str): template of the sense
+        relations (Iterable[tuple[str, str]]): (type, target usem) of the relations, in any order and possibly repeated
+
+    Returns:
+        fingerprint (str): hex digest of the sense data
+    """
+    data = json.dumps([example, template, sorted(set(relations))], ensure_ascii=False)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def relation_targets_batch(sense_ids: list[str], batch_size: int = 50, input_path: str = RELATION_TARGETS_QUERY) -> dict[str, set[tuple[str, str]]]:
+    """Retrieves only the (type, target usem) of the relations of many senses, batch_size senses for each SPARQL request
+
+    Parameters:
+        sense_ids (list[str]): senses unique identifiers
+        batch_size (int): max number of senses for each SPARQL request
+        input_path (str): path to the relation targets query
+
+    Returns:
+        targets (dict[str, set[tuple[str, str]]]): (type, target usem) of the relations of each sense
+    """
+    template = read_query(input_path)
+    targets: dict[str, set[tuple[str, str]]] = {sense_id: set() for sense_id in sense_ids}
+    unique_ids = list(targets.keys())
+    queries = [batch_relations_query(template, unique_ids[start:start + batch_size])
+               for start in range(0, len(unique_ids), batch_size)]
+    for ret in sparql_query_execute_many(queries):
+        for row in ret["results"]["bindings"]: # type: ignore
+            targets[row['sense']['value']].add((row['relation']['value'], row['target']['value']))
+    return targets
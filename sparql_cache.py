@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+CACHE_MODES = ["off", "on", "refresh", "offline"]
+"""off: no cache; on: read and write; refresh: write only; offline: read only, a miss is an error"""
+
+
+class SparqlCacheMiss(LookupError):
+    """Raised in offline mode when a query result is not in the cache"""
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes the whitespace of a SPARQL query, so that layout changes do not invalidate the cache
+
+    Parameters:
+        query (str): SPARQL query
+
+    Returns:
+        query (str): query with a single space between tokens, one line for each non empty line
+    """
+    lines = [re.sub(r"\s+", " ", line).strip() for line in query.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+class SparqlCache:
+    """Content addressed on-disk cache of SPARQL json results, keyed on (endpoint, normalized query)"""
+
+    def __init__(self, cache_dir: str = "data/sparql_cache", mode: str = "on",
+                 ttl: float|None = None, max_size_mb: float|None = None):
+        """Initialize the cache
+
+        Parameters:
+            cache_dir (str): directory containing the cached results
+            mode (str): one of CACHE_MODES
+            ttl (float): seconds after which a cached result is expired, never if None
+            max_size_mb (float): max size of the cache, the least recently used results are evicted, unbounded if None
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError("SPARQL cache mode must be one of {}: {}".format(CACHE_MODES, mode))
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.ttl = ttl
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.size: int|None = None #bytes of the cached results, counted by the first evict
+        self.lock = threading.Lock() #put and evict are called by the SparqlClient workers
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    @property
+    def readable(self) -> bool:
+        return self.mode in ("on", "offline")
+
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ("on", "refresh")
+
+
+    def path(self, endpoint: str, query: str) -> str:
+        """Returns the path of the file caching the result of a query"""
+        key = hashlib.sha256("{}\n{}".format(endpoint, normalize_query(query)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json")
+
+
+    def get(self, endpoint: str, query: str) -> dict|None:
+        """Returns the cached result of a query
+
+        Parameters:
+            endpoint (str): SPARQL endpoint
+            query (str): SPARQL query
+
+        Returns:
+            result (dict|None): cached json result, None if missing or expired
+        """
+        path = self.path(endpoint, query)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                self.misses += 1
+                return None
+            with open(path, 'r', encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path))) #access time drives the LRU eviction
+        except FileNotFoundError: #evicted by another worker after the read
+            pass
+        self.hits += 1
+        return entry["result"]
+
+
+    def put(self, endpoint: str, query: str, result: dict):
+        """Stores the result of a query, then evicts the least recently used results if the cache is too big
+
+        The size of the cache is kept by a running counter, so the cache directory is scanned only when
+        the counter exceeds max_size_mb.
+
+        Parameters:
+            endpoint (str): SPARQL endpoint
+            query (str): SPARQL query
+            result (dict): json result of the query
+        """
+        path = self.path(endpoint, query)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding="utf-8") as cache_file:
+            json.dump({"endpoint": endpoint, "query": query, "result": result}, cache_file, ensure_ascii=False)
+        if self.max_size is None:
+            os.replace(tmp_path, path)
+            return
+        with self.lock:
+            try:
+                replaced = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+            if self.size is not None:
+                self.size += os.path.getsize(path) - replaced
+            if self.size is None or self.size > self.max_size:
+                self.evict()
+
+
+    def evict(self):
+        """Removes expired results, then the least recently used ones until the cache fits max_size_mb,
+        and recounts the size of the cache. Called by put with the lock held"""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if self.ttl is not None and now - stat.st_mtime > self.ttl:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError: #removed by another process sharing the cache
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.max_size is None or total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
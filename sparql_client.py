@@ -0,0 +1,147 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from sparql_cache import SparqlCache, SparqlCacheMiss
+import os
+import random
+import requests
+import threading
+import time
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+"""HTTP status codes considered transient, the request is retried"""
+
+
+class SparqlClient:
+    """SPARQL client reusing keep-alive connections and running queries on a bounded thread pool"""
+
+    def __init__(self, endpoint: str|None = None, max_workers: int = 4, max_per_endpoint: int|None = None,
+                 retries: int = 3, backoff: float = 1.0, timeout: float = 300, cache: SparqlCache|None = None):
+        """Initialize the client
+
+        Parameters:
+            endpoint (str): default SPARQL endpoint, SPARQL_REPO environment variable if None
+            max_workers (int): number of threads executing the queries
+            max_per_endpoint (int): max number of concurrent queries sent to the same endpoint, max_workers if None
+            retries (int): number of retries for a query failed for a transient error
+            backoff (float): seconds to wait before the first retry, doubled at each retry
+            timeout (float): seconds to wait for the endpoint response
+            cache (SparqlCache): on-disk cache of the results, no cache if None
+        """
+        load_dotenv()
+        self.endpoint = endpoint or os.getenv("SPARQL_REPO")
+        self.max_workers = max_workers
+        self.max_per_endpoint = max_per_endpoint or max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Accept": "application/sparql-results+json"})
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sparql")
+        self.semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self.semaphores_lock = threading.Lock()
+
+
+    def endpoint_semaphore(self, endpoint: str) -> threading.BoundedSemaphore:
+        """Returns the semaphore limiting the concurrent queries on an endpoint"""
+        with self.semaphores_lock:
+            if endpoint not in self.semaphores:
+                self.semaphores[endpoint] = threading.BoundedSemaphore(self.max_per_endpoint)
+            return self.semaphores[endpoint]
+
+
+    def execute(self, query: str, endpoint: str|None = None) -> dict:
+        """Executes a SPARQL query, serving it from the cache when possible
+
+        Parameters:
+            query (str): SPARQL query
+            endpoint (str): SPARQL endpoint, the default one if None
+
+        Returns:
+            result (dict): json result of the query, as returned by the SPARQL protocol
+
+        Raises:
+            SparqlCacheMiss: if the cache is in offline mode and the result is not cached
+        """
+        endpoint = endpoint or self.endpoint
+        if self.cache is not None and self.cache.readable:
+            result = self.cache.get(endpoint, query) # type: ignore
+            if result is not None:
+                return result
+            if self.cache.mode == "offline":
+                raise SparqlCacheMiss("Query not in the SPARQL cache: \"{}\"".format(query[:100]))
+        result = self.query_endpoint(query, endpoint) # type: ignore
+        if self.cache is not None and self.cache.writable:
+            self.cache.put(endpoint, query, result) # type: ignore
+        return result
+
+
+    def query_endpoint(self, query: str, endpoint: str) -> dict:
+        """Sends a SPARQL query to the endpoint, retrying with exponential backoff on transient errors
+
+        Parameters:
+            query (str): SPARQL query
+            endpoint (str): SPARQL endpoint
+
+        Returns:
+            result (dict): json result of the query, as returned by the SPARQL protocol
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.endpoint_semaphore(endpoint): # type: ignore
+                    response = self.session.post(endpoint, data={"query": query}, timeout=self.timeout) # type: ignore
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError("{} Error for url: {}".format(response.status_code, endpoint), response=response)
+                retry_after = response.headers.get("Retry-After")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                retry_after = None
+            if attempt >= self.retries:
+                raise error
+            wait = self.backoff * (2 ** attempt) * (1 + random.random() / 2)
+            if retry_after is not None and retry_after.isdigit():
+                wait = max(wait, float(retry_after))
+            print("SPARQL query failed ({}), retry in {:.1f}s".format(error, wait))
+            time.sleep(wait)
+            attempt += 1
+
+
+    def submit(self, query: str, endpoint: str|None = None) -> "Future[dict]":
+        """Schedules the execution of a SPARQL query on the thread pool
+
+        Parameters:
+            query (str): SPARQL query
+            endpoint (str): SPARQL endpoint, the default one if None
+
+        Returns:
+            future (Future[dict]): future of the json result of the query
+        """
+        return self.executor.submit(self.execute, query, endpoint)
+
+
+    def execute_many(self, queries: list[str], endpoint: str|None = None) -> list[dict]:
+        """Executes many SPARQL queries concurrently
+
+        Parameters:
+            queries (list[str]): SPARQL queries
+            endpoint (str): SPARQL endpoint, the default one if None
+
+        Returns:
+            results (list[dict]): json results, in the same order of the queries
+        """
+        futures = [self.submit(query, endpoint) for query in queries]
+        return [future.result() for future in futures]
+
+
+    def close(self):
+        """Stops the thread pool and closes the pooled connections"""
+        self.executor.shutdown(wait=True)
+        self.session.close()
@@ -7,52 +7,83 @@ from langchain_openai import ChatOpenAI
 from langchain_together import ChatTogether
 from langchain_nebius import ChatNebius
 from langchain_community.llms import DeepInfra
+from llm_cache import LLMCache
+from rate_limit import UsageCallback, provider_rate_limiter
+from early_stop import early_stop_model
+from ollama_backend import OllamaPool, pooled_model
+from lexicon_store import save_pickle
+from functools import lru_cache
+import json
 import os
 from dotenv import load_dotenv
 import sys
 import pickle
 from pydantic import SecretStr
 
-def config_model(remote:str, modelname:str="", temperature=0) -> BaseChatModel:
+def config_model(remote:str, modelname:str="", temperature=0, cache:LLMCache|None=None, keep_alive:str|int|float|None=None,
+                 structured_output:bool=False, max_tokens:int|None=None, early_stop:bool=False,
+                 pool:OllamaPool|None=None) -> BaseChatModel:
     """Configure LLM model
     Parameters:
         remote (bool): use a remote model by Groq or a local model
         modelname (str): name of the model used
         temperature (float): temperature of the model
+        cache (LLMCache): persistent store of the responses, no cache if None
+        keep_alive (str|int|float): how long a local model stays loaded after the last request, Ollama default if None
+        structured_output (bool): constrained decoding of the responses: Ollama format (bound to the JSON schema of
+            each chain by prompt_rendering.structured_chain), JSON mode (response_format) for the remote chat models
+        max_tokens (int): max output tokens of a response (num_predict for Ollama, max_tokens for the remote chat models),
+            no limit if None
+        early_stop (bool): stream the responses and stop them at the end of their JSON object (see early_stop.EarlyStopMixin)
+        pool (OllamaPool): Ollama servers sharing the requests of a local model, OLLAMA_HOST or the local server if None
+    Remote chat models get the rate limiter of their service (see rate_limit.configure_rate_limits), shared by all
+    the models of the same service, and the callback passing it the token usage of the responses.
     Returns:
         llm (ChatGroq|ChatOllama): chat model ready for the prompt
     """
     load_dotenv()
+    params = ",".join(param for param in ("structured" if structured_output else "", "max_tokens={}".format(max_tokens) if max_tokens else "") if param)
+    model_cache = cache.for_model(remote or "ChatOllama", modelname, temperature, params) if cache is not None else None
 
     if remote is not None:
+        limiter = provider_rate_limiter(remote, modelname)
+        limits = {"rate_limiter": limiter, "callbacks": [UsageCallback(limiter)]} if limiter is not None else {}
+        if structured_output:
+            limits["model_kwargs"] = {"response_format": {"type": "json_object"}}
+        if max_tokens:
+            limits["max_tokens"] = max_tokens
         match remote:
             case "ChatGroq":
                 os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY", "") 
-                chat = ChatGroq(model=modelname, temperature=temperature)
+                chat = ChatGroq(model=modelname, temperature=temperature, cache=model_cache, **limits)
             case "OpenRouter":
                 os.environ["OPENROUTER_API_KEY"] = os.getenv("OPENROUTER_API_KEY", "") 
                 print(os.environ["OPENROUTER_API_KEY"])
                 chat = ChatOpenAI(model=modelname, temperature=temperature, 
-                                  base_url='https://openrouter.ai/api/v1', api_key=SecretStr(os.environ["OPENROUTER_API_KEY"] ))
+                                  base_url='https://openrouter.ai/api/v1', api_key=SecretStr(os.environ["OPENROUTER_API_KEY"] ), cache=model_cache, **limits)
             case "ChatTogether":
                 os.environ["TOGETHER_API_KEY"] = os.getenv("TOGETHER_API_KEY", "") 
-                chat = ChatTogether(model=modelname, temperature=temperature)
+                chat = ChatTogether(model=modelname, temperature=temperature, cache=model_cache, **limits)
             case "ChatVenice":
                 os.environ["VENICE_API_KEY"] = os.getenv("VENICE_API_KEY", "") 
                 print(os.environ["VENICE_API_KEY"])
                 chat = ChatOpenAI(model=modelname, temperature=temperature, 
-                                  base_url='https://api.venice.ai/api/v1', api_key=SecretStr(os.environ["VENICE_API_KEY"]))
+                                  base_url='https://api.venice.ai/api/v1', api_key=SecretStr(os.environ["VENICE_API_KEY"]), cache=model_cache, **limits)
             case "ChatNebius":
                 os.environ["NEBIUS_API_KEY"] = os.getenv("NEBIUS_API_KEY", "")
-                chat = ChatNebius(model=modelname, temperature=temperature)
+                chat = ChatNebius(model=modelname, temperature=temperature, cache=model_cache, **limits)
             case "ChatDeepInfra":
                 os.environ["DEEPINFRA_API_KEY"] = os.getenv("DEEPINFRA_API_KEY", "")
-                chat = DeepInfra(model=modelname, temperature=temperature)
+                chat = DeepInfra(model=modelname, temperature=temperature, cache=model_cache)
+                return chat #not a chat model: no output limit nor early stop
             case _:
                 print("Error when specify -r flag, value is invalid: {}".format(remote))
                 sys.exit(-1)        
-        return chat
-    return ChatOllama(model=modelname, temperature=temperature)
+    else:
+        ollama_params = {"model": modelname, "temperature": temperature, "cache": model_cache, "keep_alive": keep_alive,
+                         "format": "json" if structured_output else None, "num_predict": max_tokens}
+        chat = pooled_model(pool, **ollama_params) if pool is not None else ChatOllama(**ollama_params)
+    return early_stop_model(chat) if early_stop else chat
 
 
 def relation_to_string(relation: Relation):
@@ -83,31 +114,79 @@ def relation_to_string(relation: Relation):
     return result
 
 
-def format_relation(lemma: str, relation:gen.Relation)->str|None:
-    type = relation.type
-    if relation.lemma == "entità": #non si considerano le relationi con entita1 (superclasse di tutto)
-        return None
-    if type == "http://www.lexinfo.net/ontology/3.0/lexinfo#hyponym": #HYPONYM
-        return "\"{}\" è iponimo di \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    elif type == "http://klab/lexicon/vocabulary/compl-it#isA": 
+RELATION_TYPES_PATH = "data/relation_types.json"
+"""Default config of the relation types: Italian template of each type URI, null for the types not used in the prompts"""
+
+relation_templates: dict[str, str|None]|None = None
+"""template of each relation type URI, loaded from RELATION_TYPES_PATH at the first use"""
+
+excluded_targets: frozenset[str] = frozenset()
+"""lemmas whose relations are not used in the prompts (entità is the superclass of everything)"""
+
+missing_relation_types: set[str] = set()
+"""relation types without a template, already reported"""
+
+
+def load_relation_types(path: str = RELATION_TYPES_PATH):
+    """Loads the relation types config, replacing the one in use
+
+    The config is a json object with "types", mapping each relation type URI to its Italian template
+    with the {lemma}, {target} and {definition} fields (null if the type is not used in the prompts),
+    and "excluded_targets", the lemmas of the targets whose relations are not used.
+
+    Parameters:
+        path (str): path to the json config
+    """
+    global relation_templates, excluded_targets
+    with open(path, encoding="utf-8") as config_file:
+        config = json.load(config_file)
+    relation_templates = config["types"]
+    excluded_targets = frozenset(config.get("excluded_targets", []))
+    missing_relation_types.clear()
+    relation_text.cache_clear()
+
+
+@lru_cache(maxsize=65536)
+def relation_text(lemma: str, type: str, target_lemma: str, target_definition: str|None) -> str|None:
+    """Renders a relation with the template of its type. Hub senses are the target of relations of thousands
+    of senses, so the text is cached on (lemma, type, target lemma, target definition)"""
+    if relation_templates is None:
+        load_relation_types()
+    if target_lemma in excluded_targets:
         return None
-    elif type == "http://klab/lexicon/vocabulary/compl-it#formal":
+    if type not in relation_templates: # type: ignore
+        if type not in missing_relation_types:
+            missing_relation_types.add(type)
+            print("MISSING: {}".format(type))
         return None
-    elif type == "http://www.lexinfo.net/ontology/3.0/lexinfo#approximateSynonym":
-        return "\"{}\" è un quasi sinonimo di \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    elif type == "http://klab/lexicon/vocabulary/compl-it#synonym":
-        return "\"{}\" è un sinonimo di \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    elif type == "http://www.lexinfo.net/ontology/3.0/lexinfo#hypernym":
-        return "\"{}\" è iperonimo di \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    elif type == "http://klab/lexicon/vocabulary/compl-it#derivational":
-        return "\"{}\" è derivato da \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    elif type == "http://klab/lexicon/vocabulary/compl-it#processVerb":
-        return "\"{}\" deriva dal verbo \"{}\" nel senso di \"{}\"".format(lemma, relation.lemma, relation.definition)
-    else:
-        print("MISSING: {}".format(relation.type))
+    template = relation_templates[type] # type: ignore
+    if template is None:
         return None
+    return template.format(lemma=lemma, target=target_lemma, definition=target_definition)
+
+
+def format_relation(lemma: str, relation:gen.Relation)->str|None:
+    """Returns the description of a relation of a sense of lemma, None if the relation is not used in the prompts"""
+    return relation_text(lemma, relation.type, relation.lemma, relation.definition)
+
+
+EXCLUDE_MODES = ["none", "relations", "examples", "templates"]
+"""ablation modes of the matrix runs, "none" uses all the features"""
+
+
+def mode_exclude(mode: str) -> str|None:
+    """Returns the -x|--exclude value of an ablation mode"""
+    return None if mode == "none" else mode
+
+
+def mode_path(path: str, mode: str) -> str:
+    """Returns the path of the file of an ablation mode, e.g. output/defs.json -> output/defs_relations.json, output/defs.jsonl.gz -> output/defs_relations.jsonl.gz"""
+    filename, file_extension = os.path.splitext(path)
+    if file_extension in (".gz", ".zst"): #keep the format extension before the compression one
+        filename, format_extension = os.path.splitext(filename)
+        file_extension = format_extension + file_extension
+    return "{}_{}{}".format(filename, mode, file_extension)
 
 
 def save_to_pickle(save_path, objs):
-    with open(save_path, 'wb') as out_file:
-        pickle.dump(objs,out_file)
\ No newline at end of file
+    save_pickle(save_path, objs) #atomic: a crash while saving keeps the previous pickle
\ No newline at end of file